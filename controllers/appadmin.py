@@ -41,7 +41,9 @@ response.menu = [[T('design'), False, URL('admin', 'default', 'design',
                  args=[request.application])], [T('db'), False,
                  URL('index')], [T('state'), False,
                  URL('state')], [T('cache'), False,
-                 URL('ccache')]]
+                 URL('ccache')], [T('jqgrid indexes'), False,
+                 URL('jqgrid_indexes')], [T('jqgrid build'), False,
+                 URL('jqgrid_build')]]
 
 # ##########################################################
 # ## auxiliary functions
@@ -408,3 +410,32 @@ def ccache():
     return dict(form=form, total=total,
                 ram=ram, disk=disk)
 
+
+def jqgrid_indexes():
+    """Report the indexes missing for the jqgrids created since the server
+    started, and create them on request."""
+    from applications.jqgrid.modules.jqgrid import JqGrid
+    form = FORM(
+        P(TAG.BUTTON(T("Create missing indexes"), _type="submit",
+                     _name="create", _value="yes")),
+    )
+    create = form.accepts(request.vars, session)
+    reports = {}
+    for (key, db) in get_databases(request).items():
+        reports[key] = JqGrid.index_report(db, create=create)
+    return dict(form=form, reports=reports)
+
+
+def jqgrid_build():
+    """Report the jqGrid features used by the jqgrids created since the
+    server started, and build a jqGrid of only those on request."""
+    from applications.jqgrid.modules.jqgrid import JqGrid
+    form = FORM(
+        P(TAG.BUTTON(T("Build jqGrid"), _type="submit",
+                     _name="build", _value="yes")),
+    )
+    build = None
+    if form.accepts(request.vars, session):
+        build = JqGrid.jqgrid_build(request.folder)
+    return dict(form=form, grids=JqGrid.grid_features, build=build,
+                custom=JqGrid.custom_jqgrid_build)
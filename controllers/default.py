@@ -455,12 +455,8 @@ def custom_orderby():
         orderby = db.things.price | db.things.name
         if request.vars.sord == 'desc':
             orderby = ~db.things.price | ~db.things.name
-    # Mmm, sorting doesn't work quite well with reference field yet.
-    # i.e. "category" in this demo db table
-    # if request.vars.sidx == 'category':
-    #     orderby = 'things.name'
-    #     #if request.vars.sord == 'desc':
-    #     #    orderby = ~orderby
+    # Reference fields, i.e. "category" in this demo db table, sort by the
+    # label of the referenced record, see JqGrid.label_orderby()
     return dict(foo=JqGrid(
         globals(),
         db.things,
@@ -661,9 +657,7 @@ def toolbar_searching():
                 'stype':'select',
                 'editoptions':{
                     'multiple':True,
-                    'value':":;" + ';'.join('%s:%s' % (r['id'], r['name'])
-                        for r in db(db.category.id > 0).select(
-                        db.category.id, db.category.name))
+                    'value': JqGrid.select_options(db.things.category)
                     },
                 },
               {'name': 'price', 'index':'price'},
@@ -717,9 +711,7 @@ def form_editing():
                     'editable': True,
                     'edittype':'select',          # Turns input into drop down
                     'editoptions': {
-                      'value': ":;" + ';'.join('%s:%s' % (r['id'], r['name'])
-                          for r in db(db.category.id > 0).select(
-                          db.category.id, db.category.name))
+                      'value': JqGrid.select_options(db.things.category)
                     },
                 },
                 {
@@ -814,9 +806,7 @@ def form_editing_custom():
                   'editable': True,
                   'edittype':'select',          # Turns input into drop down
                   'editoptions': {
-                    'value': ":;" + ';'.join('%s:%s' % (r['id'], r['name'])
-                        for r in db(db.category.id > 0).select(
-                        db.category.id, db.category.name))
+                    'dataUrl': True,     # Options fetched when the form opens
                   },
                   'width': 100,
               },
@@ -65,12 +65,44 @@ Requirements (by default they come with the JqGrid standalone app):
 """
 
 import gluon.contrib.simplejson as json
-from gluon.html import DIV, SCRIPT, TABLE, URL
-from gluon.http import HTTP
+import gluon.contrib.simplejson.encoder as json_encoder
+from gluon.dal import Expression, Field, FieldLazy, FieldVirtual, Query, \
+        Row, Rows, VirtualCommand
+from gluon.html import DIV, INPUT, SCRIPT, TABLE, URL, xmlescape
+from gluon.http import HTTP, redirect
+from gluon.serializers import json as json_serializer
+from gluon.streamer import streamer
+from gluon.tools import Crud, callback
+from collections import OrderedDict
 from string import Template
+import cPickle
+import calendar
+import datetime
+import decimal
+import hashlib
+import inspect
 import math
 import logging
+import os
+import posixpath
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None            # No memory engine, see JqGrid.memory_engine
+
+try:
+    from gluon.contrib.minify import cssmin, jsmin
+except ImportError:
+    cssmin = jsmin = None   # See JqGrid.strip_css and JqGrid.strip_js
 
 DEFAULT = '__USE_DEFAULT_SETTING__'
 
@@ -104,22 +136,380 @@ class Raw(object):
 
 
 class JSONEncoderRaw(json.JSONEncoder):
-    "Raw objects will be encoded as-is. So output might not be strict json."
-    PLACEHOLDER_PATTERN = re.compile(r'"__RAW__-?\d+"')
-    locker = {}
-
-    def default(self, obj):
-        if isinstance(obj, Raw):
-            signature = '__RAW__%s' % id(obj)
-            self.locker['"%s"' % signature] = obj.as_is()
-            return signature
-        return json.JSONEncoder.default(self, obj)
-
-    def encode(self, o):
-        result = json.JSONEncoder.encode(self, o)
-        for placeholder in self.PLACEHOLDER_PATTERN.findall(result):
-            result = result.replace(placeholder, self.locker.pop(placeholder))
-        return result
+    """Raw objects will be encoded as-is. So output might not be strict json.
+
+    Raw payloads are written in place, in the one encoding pass, so there
+    are no placeholders to substitute afterwards, and no state shared by
+    concurrent calls.
+    """
+
+    def iterencode(self, o, _one_shot=False):
+        """Return the list of strings making the encoding of o."""
+        chunks = []
+        append = chunks.append
+        encode_string = json_encoder.encode_basestring_ascii \
+                if self.ensure_ascii else json_encoder.encode_basestring
+        encoding = self.encoding
+        markers = {} if self.check_circular else None
+        key_separator = self.key_separator
+        item_separator = self.item_separator
+
+        def encode_float(o):
+            if o != o or o in (float('inf'), float('-inf')):
+                if not self.allow_nan:
+                    raise ValueError('Out of range float values are not '
+                            'JSON compliant: %r' % o)
+                return 'NaN' if o != o else \
+                        'Infinity' if o > 0 else '-Infinity'
+            return repr(o)
+
+        def encode_key(key):
+            if isinstance(key, basestring):
+                return key
+            elif key is True:
+                return 'true'
+            elif key is False:
+                return 'false'
+            elif key is None:
+                return 'null'
+            elif isinstance(key, (int, long)):
+                return str(key)
+            elif isinstance(key, float):
+                return encode_float(key)
+            elif self.skipkeys:
+                return None
+            raise TypeError('key %r is not a string' % (key,))
+
+        def encode(o, level):
+            if isinstance(o, basestring):
+                if isinstance(o, str) and encoding not in (None, 'utf-8'):
+                    o = o.decode(encoding)
+                append(encode_string(o))
+            elif o is None:
+                append('null')
+            elif o is True:
+                append('true')
+            elif o is False:
+                append('false')
+            elif isinstance(o, (int, long)):
+                append(str(o))
+            elif isinstance(o, float):
+                append(encode_float(o))
+            elif isinstance(o, Raw):
+                append(o.as_is())
+            elif isinstance(o, (dict, list, tuple)):
+                if markers is not None:
+                    if id(o) in markers:
+                        raise ValueError('Circular reference detected')
+                    markers[id(o)] = o
+                if self.indent is None:
+                    first, separator = '', item_separator
+                else:
+                    level += 1
+                    first = '\n' + self.indent * level
+                    separator = item_separator + first
+                if isinstance(o, dict):
+                    items = sorted(o.iteritems()) if self.sort_keys \
+                            else o.iteritems()
+                    append('{')
+                    for key, value in items:
+                        key = encode_key(key)
+                        if key is None:
+                            continue
+                        append(first)
+                        first = separator
+                        append(encode_string(key))
+                        append(key_separator)
+                        encode(value, level)
+                    closing = '}'
+                else:
+                    append('[')
+                    for value in o:
+                        append(first)
+                        first = separator
+                        encode(value, level)
+                    closing = ']'
+                if self.indent is not None and len(o):
+                    append('\n' + self.indent * (level - 1))
+                append(closing)
+                if markers is not None:
+                    del markers[id(o)]
+            elif self.use_decimal and isinstance(o, decimal.Decimal):
+                append(str(o))
+            else:
+                if markers is not None:
+                    if id(o) in markers:
+                        raise ValueError('Circular reference detected')
+                    markers[id(o)] = o
+                encode(self.default(o), level)
+                if markers is not None:
+                    del markers[id(o)]
+        encode(o, 0)
+        return chunks
+
+
+class ColumnStore(object):
+    """In-memory copy of a table, column by column, in NumPy arrays.
+
+    Numeric and boolean columns are arrays of their values, with a mask of
+    nulls. Other columns are dictionary encoded: a sorted list of their
+    distinct values, and an array of codes into it, -1 for null, so codes
+    sort as the values do and a filter is evaluated once per distinct value.
+
+    Used by JqGrid when memory_engine is True, see JqGrid.memory_data().
+    Queries and orderbys it can't evaluate raise NotImplementedError. So do
+    filters and sorts on strings, unless the database is SQLite, whose
+    binary collation and ASCII case folding of LIKE are reproduced: other
+    databases compare strings by their collation, and PostgreSQL matches
+    STARTSWITH, ENDSWITH and CONTAINS case-insensitively.
+    """
+    numeric_types = ('id', 'integer', 'bigint', 'float', 'double', 'boolean')
+    string_types = ('string', 'text', 'password', 'upload')
+
+    def __init__(self, table):
+        """Load all the records of table.
+
+        No reference to table is kept, so the store can outlive the request.
+        """
+        db = table._db
+        adapter = db._adapter
+        adapter.build_parsemap()
+        self.tablename = str(table)
+        self.names = list(table.fields)
+        self.string_semantics = adapter.dbengine == 'sqlite'
+        self.nulls_first = JqGrid.nulls_sort_first(db)
+        self.types = dict((f, table[f].type) for f in self.names)
+        records = db.executesql(db(table.id > 0)._select(
+                *[table[f] for f in self.names]))
+        self.columns = {}       # name: array of values, or of codes
+        self.nulls = {}         # name: boolean array, True for null
+        self.dictionaries = {}  # name: sorted list of distinct values
+        self.sort_keys = {}     # name: array, see sort_key()
+        self.nbytes = 0
+        for i, name in enumerate(self.names):
+            field = table[name]
+            values = [adapter.parse_value(r[i], field.type) for r in records]
+            if field.filter_out:
+                values = [field.filter_out(v) for v in values]
+            self.load_column(name, field.type, values)
+        self.ids = self.columns['id']
+        self.size = len(records)
+
+    def load_column(self, name, field_type, values):
+        """Store the values of a column, see ColumnStore."""
+        nulls = numpy.array([v is None for v in values], dtype=bool)
+        if field_type in self.numeric_types or \
+                field_type.startswith('reference'):
+            dtype = float if field_type in ('float', 'double') else \
+                    bool if field_type == 'boolean' else numpy.int64
+            self.columns[name] = numpy.array(
+                    [0 if v is None else v for v in values], dtype=dtype)
+            self.nulls[name] = nulls
+            self.nbytes += self.columns[name].nbytes + nulls.nbytes
+            return
+        if field_type.startswith('list:'):
+            values = [None if v is None else tuple(v) for v in values]
+        distinct = sorted(set(v for v in values if v is not None))
+        codes = dict((v, i) for i, v in enumerate(distinct))
+        self.dictionaries[name] = distinct
+        self.columns[name] = numpy.array(
+                [-1 if v is None else codes[v] for v in values],
+                dtype=numpy.int32)
+        self.nulls[name] = nulls
+        self.nbytes += self.columns[name].nbytes + nulls.nbytes + \
+                sum(sys.getsizeof(v) for v in distinct)
+
+    def mask(self, query):
+        """Return a boolean array, True for the records matching query."""
+        op = getattr(query.op, '__name__', None)
+        first, second = query.first, query.second
+        if op == 'AND':
+            return self.mask(first) & self.mask(second)
+        if op == 'OR':
+            return self.mask(first) | self.mask(second)
+        if op == 'NOT':
+            return ~self.mask(first)
+        if not isinstance(first, Field) or \
+                first.tablename != self.tablename or \
+                first.name not in self.columns or \
+                isinstance(second, (Expression, Query)):
+            raise NotImplementedError('No memory query for %s' % query)
+        name = first.name
+        if op in ('EQ', 'NE') and second is None:
+            return self.nulls[name] if op == 'EQ' else ~self.nulls[name]
+        self.check_strings(name)
+        if name in self.dictionaries:
+            # Evaluated on distinct values, the extra False is for null
+            distinct = self.dictionaries[name]
+            match = self.predicate(op, second, first.type)
+            return numpy.array([match(v) for v in distinct] + [False],
+                    dtype=bool)[self.columns[name]]
+        values = self.columns[name]
+        if op == 'BELONGS' and isinstance(second, (list, tuple, set)) and \
+                not [x for x in second
+                    if not isinstance(x, (int, long, float, bool))]:
+            result = numpy.in1d(values, list(second))
+        elif op in self.comparisons and \
+                isinstance(second, (int, long, float, bool)):
+            result = self.comparisons[op](values, second)
+        else:
+            raise NotImplementedError('No memory query for %s' % query)
+        return result & ~self.nulls[name]
+
+    comparisons = {
+            'EQ': lambda a, b: a == b, 'NE': lambda a, b: a != b,
+            'LT': lambda a, b: a < b, 'LE': lambda a, b: a <= b,
+            'GT': lambda a, b: a > b, 'GE': lambda a, b: a >= b,
+            }
+
+    def is_string(self, field_type):
+        """Return True if values of field_type compare as strings."""
+        return field_type in self.string_types or \
+                field_type.startswith('list:')
+
+    def check_strings(self, name):
+        """Raise NotImplementedError if column name holds strings and the
+        database compares them otherwise than python, see ColumnStore.
+        """
+        if not self.string_semantics and self.is_string(self.types[name]):
+            raise NotImplementedError('No memory string semantics of %s '
+                    'for %s' % (self.types[name], name))
+
+    def predicate(self, op, second, field_type):
+        """Return a function telling if a distinct value of a dictionary
+        encoded column matches "column op second".
+        """
+        if op in self.comparisons:
+            if isinstance(second, basestring) != self.is_string(field_type):
+                # eg a date compared to a string, python 2 would not complain
+                raise NotImplementedError('No memory %s on %s' % (op, second))
+            compare = self.comparisons[op]
+            return lambda v: compare(v, second)
+        if op == 'BELONGS' and isinstance(second, (list, tuple, set)):
+            second = set(second)
+            return lambda v: v in second
+        if op == 'CONTAINS' and field_type.startswith('list:'):
+            return lambda v: second in v
+        patterns = {'LIKE': '%s', 'STARTSWITH': '%s%%', 'ENDSWITH': '%%%s',
+                'CONTAINS': '%%%s%%'}
+        if op not in patterns or not isinstance(second, basestring):
+            raise NotImplementedError('No memory %s on %s' % (op, second))
+        pattern = re.compile('^%s$' % ''.join(
+                '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+                for c in patterns[op] % second),
+                re.DOTALL | re.IGNORECASE)     # as SQLite, ASCII only
+        return lambda v: pattern.match(str(v)) is not None
+
+    def sort_key(self, name):
+        """Return an array sorting as the column does in SQL, with nulls
+        first or last as the database sorts them.
+        """
+        if name not in self.sort_keys:
+            if name in self.dictionaries:
+                key = self.columns[name].copy()
+                if not self.nulls_first:
+                    key[self.nulls[name]] = len(self.dictionaries[name])
+            else:
+                key = self.columns[name].astype(float)
+                key[self.nulls[name]] = \
+                        -numpy.inf if self.nulls_first else numpy.inf
+            self.sort_keys[name] = key
+        return self.sort_keys[name]
+
+    def order(self, indexes, orderby):
+        """Return indexes, an array of record positions, sorted by orderby,
+        a list of fields, inverted (~) for descending order."""
+        keys = []
+        for item in orderby:
+            descending = getattr(item, 'op', None) is not None and \
+                    getattr(item.op, '__name__', None) == 'INVERT'
+            if descending:
+                item = item.first
+            if not isinstance(item, Field) or \
+                    item.tablename != self.tablename or \
+                    item.name not in self.columns:
+                raise NotImplementedError('No memory orderby %s' % item)
+            self.check_strings(item.name)
+            key = self.sort_key(item.name)[indexes]
+            keys.append(-key if descending else key)
+        keys.append(self.ids[indexes])      # Ties by id
+        return indexes[numpy.lexsort(keys[::-1])]
+
+    def row(self, index, names):
+        """Return a dict of the values of a record, for the columns names."""
+        values = {}
+        for name in names:
+            if self.nulls[name][index]:
+                values[name] = None
+            elif name in self.dictionaries:
+                value = self.dictionaries[name][self.columns[name][index]]
+                values[name] = list(value) if isinstance(value, tuple) \
+                        else value
+            else:
+                values[name] = self.columns[name][index].item()
+        return values
+
+
+class PageCache(object):
+    """In-process LRU cache of jqgrid data pages, limited in bytes.
+
+    It is called like web2py's cache.ram, so either can be a page_cache:
+        body = cache(key, lambda: render(), time_expire)
+
+    Usage in your model:
+        class CachedJqGrid(JqGrid):
+            page_cache = PageCache(16 * 1024 * 1024)
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: integer, the least recently used pages are dropped
+                beyond that many bytes of cached bodies.
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.storage = OrderedDict()        # key: (time, value, size)
+        self.lock = threading.Lock()
+
+    def __call__(self, key, f, time_expire=300):
+        """Return the value cached under key, if younger than time_expire
+        seconds, else the value of f(), cached. If f is None, key is cleared.
+        """
+        with self.lock:
+            item = self.storage.pop(key, None)
+            if item:
+                self.bytes -= item[2]
+                if f is not None and time.time() - item[0] < time_expire:
+                    self.storage[key] = item
+                    self.bytes += item[2]
+                    return item[1]
+        if f is None:
+            return None
+        value = f()
+        size = len(value) if isinstance(value, str) else 0
+        if size > self.max_bytes:
+            return value
+        with self.lock:
+            old = self.storage.pop(key, None)
+            if old:
+                self.bytes -= old[2]
+            self.storage[key] = (time.time(), value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self.storage.popitem(last=False)[1][2]
+        return value
+
+    def clear(self, regex=None):
+        """Clear the keys matching regex, all keys if None."""
+        with self.lock:
+            if regex is None:
+                self.storage.clear()
+                self.bytes = 0
+                return
+            pattern = re.compile(regex)
+            for key in [k for k in self.storage if pattern.match(k)]:
+                self.bytes -= self.storage.pop(key)[2]
 
 
 class JqGrid(object):
@@ -140,7 +530,7 @@ class JqGrid(object):
     default_options = default_jqgrid_options      # for backward compatibility
     default_nav_grid_options = {
         # http://www.trirand.com/jqgridwiki/doku.php?id=wiki:navigator
-        'search': False,  # as of 2011-08-03 navGrid Search not implemented
+        'search': False,  # True for the search dialog, see search_query()
         'add': False, 'edit': False, 'del': False, 'view': False,
         'refresh': False,
         }
@@ -150,6 +540,83 @@ class JqGrid(object):
     default_nav_search_options = {}     # e.g. {'width': 400, 'caption': '?'}
     default_nav_view_options = {}   # e.g. {'width': 400, 'caption': '='}
     default_filter_toolbar_options = None  # None to disable, {...} to enable
+    keyset_paging = False       # True to seek by (sidx, id) on next/prev page
+    record_count_cache = False  # True to cache data_records() until cud()
+    record_count_ttl = 300      # seconds, also limits staleness of the cache
+    record_count_cache_size = 1000  # number of cached counts kept
+    approximate_records_threshold = None    # e.g. 100000, see count_records()
+    count_over_window = False   # True to get rows and count in one query
+    count_free = False          # True to skip counting, eg for {'scroll': 1}
+    virtual_field_dependencies = {}     # e.g. {'markup': ['price', 'cost']}
+    # e.g. {'markup': lambda t: t.price / t.cost}, see data_fields()
+    virtual_field_expressions = {}
+    raw_rows = False            # True to skip building DAL Rows, see data_rows
+    numeric_filter_digits = 12  # filters match numbers below 10 ** digits
+    full_text_fields = []       # e.g. ['name', 'owner'], see full_text_query()
+    memory_engine = False       # True to page the table in memory (NumPy)
+    memory_budget = 64 * 1024 * 1024    # bytes, larger tables stay in SQL
+    memory_ttl = 300            # seconds, also limits staleness, see cud()
+    select_options_ttl = 300    # seconds, see select_options()
+    search_cache_size = 100     # number of compiled searches kept
+    batch_reference_labels = True   # False to represent references per row
+    sort_references_by_label = True     # False to sort references by id
+    label_sort_columns = {}     # e.g. {'category': 'category_label'}
+    bulk_delete = True          # False to delete row by row, see cud()
+    stream_data = False         # True to write data in chunks, see data_stream
+    stream_chunk_size = 500     # rows fetched from the cursor at a time
+    stream_spool_size = 1024 * 1024     # bytes kept in memory, then on disk
+    compact_rows = False        # True to send rows as arrays, see compact_data
+    dictionary_columns = []     # e.g. ['category'], see compact_data()
+    compress_data = False       # True to gzip/deflate data, see compress()
+    compression_level = 6       # 1 (fastest) to 9 (smallest)
+    compression_min_size = 1024     # bytes, smaller bodies are sent as is
+    compressed_cache_size = 0   # number of compressed bodies kept, 0 for none
+    script_cache_size = 100     # number of generated scripts kept, 0 for none
+    script_url_options = ('url', 'editurl')     # injected per request
+    bundle_response_files = False   # True to serve them as 2 files, see bundle
+    custom_jqgrid_build = False     # True to load jqgrid_build_file, if built
+    jqgrid_build_file = 'jqgrid/js/jquery.jqGrid.custom.min.js'
+
+    compressed_bodies = OrderedDict()   # (encoding, level, md5): body
+    compressed_bodies_lock = threading.Lock()
+    etag_data = False           # True to answer If-None-Match with 304
+    page_cache = None           # 'ram', 'disk' or a PageCache, see cached_page
+    page_cache_ttl = 60         # seconds, also limits staleness, see cud()
+
+    data_versions = {}          # (db, table): integer, see data_version()
+    data_versions_lock = threading.Lock()
+    data_version_prefix = uuid.uuid4().hex[:8]     # unique to this process
+    data_version_ttl = 60       # seconds a process-local version lasts
+    shared_versions = {}        # db: Table, see share_data_versions()
+    watched_tables = set()      # (db, table), see watch_table()
+
+    record_counts = OrderedDict()   # (db, table, query): (time, version, n)
+    record_counts_lock = threading.Lock()
+
+    registered_grids = {}       # (db, list_table_id): (table, options)
+
+    full_text_tables = {}       # (db, table, fields): FTS5 table or None
+    full_text_tables_lock = threading.Lock()
+
+    compiled_searches = OrderedDict()   # (db, table, search): SQL
+    compiled_searches_lock = threading.Lock()
+
+    memory_stores = {}          # (db, table): (time, version, ColumnStore)
+    memory_stores_lock = threading.Lock()
+
+    select_options_cache = {}   # (db, table): (time, version, options)
+    select_options_lock = threading.Lock()
+
+    grid_features = {}          # list_table_id: set, see used_features()
+    asset_bundles = {}          # (folder, paths): (source stats, bundle name)
+    asset_bundles_lock = threading.Lock()
+
+    scripts = OrderedDict()     # md5 of options: (template, features)
+    scripts_lock = threading.Lock()
+
+    page_caches = set()         # PageCache instances in use, see invalidate()
+    page_cache_stats = {}       # grid class name: {'hits': n, 'misses': n}
+    page_cache_stats_lock = threading.Lock()
 
     template = '''
         jQuery(document).ready(function(){
@@ -202,6 +669,14 @@ class JqGrid(object):
             options.update(jqgrid_options)
         options.setdefault(
                 'colModel', [{'name':f, 'index':f} for f in table.fields])
+        if self.etag_data:
+            # No nd cache buster, so the browser revalidates the same url
+            options['prmNames'] = dict({'nd': None},
+                    **(options.get('prmNames') or {}))
+        if self.compact_rows:
+            # Rows are arrays of cells, followed by the id, see compact_data()
+            options.setdefault('jsonReader', {'repeatitems': True,
+                    'cell': '', 'id': str(len(options['colModel']))})
         if not 'colNames' in options:
             options['colNames'] = [table[item['name']].label
                     if item['name'] in table else
@@ -210,6 +685,37 @@ class JqGrid(object):
                     for item in options['colModel']]
         self.pager_div_id = pager_div_id or ('jqgrid_pager_%s' % table)
         self.list_table_id = list_table_id or ('jqgrid_list_%s' % table)
+        # Remembered for the index advisor, see index_advice()
+        self.registered_grids[(table._db._uri_hash, self.list_table_id)] = (
+                str(table), {'colModel': options['colModel'],
+                    'sortname': options.get('sortname')})
+        # {'dataUrl': True} serves the options of a reference column. The
+        # colModel is copied, it may be a constant shared between requests.
+        col_model = []
+        for item in options['colModel']:
+            for key in ('editoptions', 'searchoptions'):
+                if (item.get(key) or {}).get('dataUrl') is True:
+                    item = dict(item)
+                    item[key] = dict(item[key], dataUrl=URL(r=request,
+                            args=request.args, vars={
+                                'w2p_jqgrid_action': 'select',
+                                'w2p_list_table_id': self.list_table_id,
+                                'w2p_field': item['name']}))
+            col_model.append(item)
+        options['colModel'] = col_model
+        if request.vars.get('w2p_jqgrid_action') == 'select' and \
+                request.vars.get('w2p_list_table_id') == self.list_table_id:
+            name = request.vars.get('w2p_field')
+            if name not in table.fields or \
+                    self.referenced_table(table[name]) is None:
+                raise HTTP(404)
+            etag = 'W/"%s"' % self.data_version(
+                    self.referenced_table(table[name]))
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag in [x.strip() for x in
+                    (request.env.http_if_none_match or '').split(',')]:
+                raise HTTP(304, **headers)
+            raise HTTP(200, self.select_options_html(table[name]), **headers)
         data_vars = {'w2p_jqgrid_action': 'data',
                 'w2p_list_table_id': self.list_table_id}
         data_vars.update(request.vars)
@@ -219,10 +725,33 @@ class JqGrid(object):
                 args=request.args, vars=data_vars))
         if request.vars.get('w2p_jqgrid_action') == 'data' and \
                 request.vars.get('w2p_list_table_id') == self.list_table_id:
-            environment['response'].view = 'generic.json'
-            raise HTTP(200, environment['response'].render(self.data(
-                    environment, table, query=query, orderby=orderby,
-                    fields=[v.get('name') for v in options['colModel']])))
+            fields = [v.get('name') for v in options['colModel']]
+            headers = {}
+            if self.etag_data:
+                etag = self.data_etag(environment, table, query, fields)
+                headers.update({'ETag': etag, 'Cache-Control': 'no-cache'})
+                if etag in [x.strip() for x in
+                        (request.env.http_if_none_match or '').split(',')]:
+                    raise HTTP(304, **headers)
+
+            def render():
+                data = self.data(environment, table, query=query,
+                        orderby=orderby, fields=fields)
+                if self.compact_rows:
+                    data = self.compact_data(data, fields)
+                if self.stream_data:
+                    return self.data_stream(data)
+                environment['response'].view = 'generic.json'
+                return environment['response'].render(data)
+            if self.page_cache and not self.stream_data:
+                body = self.cached_page(environment, table, query, fields,
+                        render)
+            else:
+                body = render()
+            headers['Content-Type'] = 'application/json'
+            if self.compress_data:
+                body = self.compress(environment, body, headers)
+            raise HTTP(200, body, **headers)
 
         options.setdefault('editurl', URL(r=request, args=request.args,
                 vars={'w2p_jqgrid_action': 'cud',
@@ -247,6 +776,38 @@ class JqGrid(object):
                 onSelectRow: function(id){
                     window.location.href = '%s'.replace('{id}', id);
                 },''' % select_callback_url
+        if self.keyset_paging:
+            # Echo the page boundaries of the previous response, see data(),
+            # then hand postData to the serializeGridData of the options
+            serialize = options.pop('serializeGridData', None)
+            if serialize is not None and not isinstance(serialize, Raw):
+                raise ValueError('serializeGridData must be a Raw function')
+            self.callbacks += '''
+                serializeGridData: function(postData){
+                    var userdata = jQuery(this).jqGrid('getGridParam',
+                            'userData');
+                    if (userdata && userdata.w2p_keyset) {
+                        postData.w2p_keyset = JSON.stringify(
+                                userdata.w2p_keyset);
+                    }
+                    return %s;
+                },''' % ('postData' if serialize is None else
+                        '(%s).call(this, postData)' % serialize.as_is())
+        if self.compact_rows and self.dictionary_columns:
+            # Decode dictionary encoded cells, see compact_data()
+            self.callbacks += '''
+                beforeProcessing: function(data){
+                    var dict = data.userdata && data.userdata.w2p_dictionary;
+                    if (dict) {
+                        jQuery.each(data.rows, function(i, row){
+                            jQuery.each(dict, function(j, values){
+                                if (row[j] !== null) {
+                                    row[j] = values[row[j]];
+                                }
+                            });
+                        });
+                    }
+                },'''
 
         self.nav_grid_options = self.default_nav_grid_options \
                 if nav_grid_options == DEFAULT else nav_grid_options
@@ -280,21 +841,317 @@ class JqGrid(object):
         """
         appname = JqGrid.__module__.split('.')[1]   # Auto detect this app name
         if not response_files:      # then use default location
-            response_files = [
-                    URL(a=appname, c='static', f=x, extension=False) for x in [
+            paths = [
                     'jqueryui/css/%s/jquery-ui.custom.css' % theme,
                     'jqueryui/js/jquery-ui.custom.min.js',
                     'jqgrid/css/ui.jqgrid.css',
                     'jqgrid/js/i18n/grid.locale-%s.js' % (lang or 'en'),
-                    'jqgrid/js/jquery.jqGrid.min.js',
+                    cls.jqgrid_build_file if cls.custom_jqgrid_build and
+                        os.path.isfile(os.path.join(
+                            environment['request'].folder, 'static',
+                            cls.jqgrid_build_file)) else
+                        'jqgrid/js/jquery.jqGrid.min.js',
                     'jquery-ui-timepicker-addon/jquery-ui-timepicker-addon.css',
                     'jquery-ui-timepicker-addon/jquery-ui-timepicker-addon.js',
-                    ]]
+                    ]
+            if cls.bundle_response_files:
+                response_files = [cls.bundle(environment,
+                        [x for x in paths if x.endswith(extension)])
+                        for extension in ('.css', '.js')]
+            else:
+                response_files = [URL(a=appname, c='static', f=x,
+                        extension=False) for x in paths]
         environment['response'].files.extend(response_files)
         return response_files
 
+    @classmethod
+    def bundle(cls, environment, paths):
+        """Return the url of one file concatenating the static files paths,
+        all .css or all .js, minified by gluon.contrib.minify if available,
+        else by strip_css() or strip_js().
+
+        The bundle is written in static/bundles, named after the md5 of the
+        paths and of its content, and rebuilt when a source file changes,
+        removing the bundles of the same paths it supersedes. Its url goes
+        through web2py's versioned static path, so it is served with
+        far-future cache headers: a change of content is a change of name.
+
+        Args:
+            environment: dict, should be: globals()
+            paths: list of paths relative to the static folder
+
+        Return:
+            string, url of the bundle
+        """
+        appname = JqGrid.__module__.split('.')[1]   # Auto detect this app name
+        static = os.path.join(environment['request'].folder, 'static')
+        extension = os.path.splitext(paths[0])[1]
+        stats = []
+        for path in paths:
+            stat = os.stat(os.path.join(static, path))
+            stats.append((stat.st_mtime, stat.st_size))
+        key = (static, tuple(paths))
+        with cls.asset_bundles_lock:
+            cached = cls.asset_bundles.get(key)
+        if cached and cached[0] == stats:
+            name = cached[1]
+        else:
+            chunks = []
+            for path in paths:
+                with open(os.path.join(static, path), 'rb') as f:
+                    text = f.read()
+                if extension == '.css':
+                    text = cls.rebase_css(text, posixpath.dirname(path),
+                            'bundles')
+                if not path.endswith('.min' + extension):
+                    if extension == '.css':
+                        text = cssmin.cssmin(text) if cssmin else \
+                                cls.strip_css(text)
+                    elif extension == '.js':
+                        text = jsmin.jsmin(text) if jsmin else \
+                                cls.strip_js(text)
+                chunks.append(text)
+            # A script without a final semicolon must not run into the next
+            body = ('\n' if extension == '.css' else ';\n').join(chunks)
+            prefix = 'jqgrid-%s-' % hashlib.md5(
+                    '\n'.join(paths)).hexdigest()[:8]
+            name = '%s%s%s' % (prefix, hashlib.md5(body).hexdigest()[:12],
+                    extension)
+            folder = os.path.join(static, 'bundles')
+            filename = os.path.join(folder, name)
+            if not os.path.exists(filename):
+                try:
+                    os.makedirs(folder)
+                except OSError:         # Exists, maybe made by another thread
+                    pass
+                temporary = '%s.%s' % (filename, uuid.uuid4().hex)
+                with open(temporary, 'wb') as f:
+                    f.write(body)
+                os.rename(temporary, filename)
+                for old in os.listdir(folder):
+                    if old.startswith(prefix) and old.endswith(extension) \
+                            and old != name:
+                        try:
+                            os.remove(os.path.join(folder, old))
+                        except OSError:     # Removed by another process
+                            pass
+            with cls.asset_bundles_lock:
+                cls.asset_bundles[key] = (stats, name)
+        # web2py adds the segment of response.static_version itself. Without
+        # one, any _x.y.z segment still gets the far-future cache headers,
+        # and as the name changes with the content, 0.0.0 never goes stale.
+        version = '' if environment['response'].static_version else '_0.0.0/'
+        return URL(a=appname, c='static', f='%sbundles/%s' % (version, name),
+                extension=False)
+
+    @staticmethod
+    def rebase_css(text, folder, bundle_folder):
+        """Return the css text with its relative url()s, relative to folder,
+        made relative to bundle_folder, both relative to the static folder.
+        """
+        def rebase(match):
+            url = match.group(2)
+            if re.match(r'^([a-z]+:|/|#)', url, re.I):
+                return match.group(0)   # data:, http://, absolute or fragment
+            url = posixpath.relpath(posixpath.normpath(
+                    posixpath.join(folder, url)), bundle_folder)
+            return 'url(%s%s%s)' % (match.group(1), url, match.group(1))
+        return re.sub(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""", rebase, text)
+
+    # The jqGrid 4.3.3 modules of static/jqgrid/src, in build order
+    jqgrid_modules = ['grid.base.js', 'jquery.fmatter.js', 'grid.custom.js',
+            'grid.common.js', 'grid.formedit.js', 'grid.filter.js',
+            'grid.inlinedit.js', 'grid.celledit.js', 'jqModal.js', 'jqDnR.js',
+            'grid.subgrid.js', 'grid.grouping.js', 'grid.treegrid.js',
+            'grid.import.js', 'JsonXml.js', 'grid.tbltogrid.js',
+            'grid.jqueryui.js']
+
+    # feature: (modules it needs, regex of the jqgrid scripts using it)
+    jqgrid_features = {
+        'base': (['grid.base.js', 'jquery.fmatter.js'], None),
+        'formedit': (['grid.common.js', 'jqModal.js', 'jqDnR.js',
+                'grid.formedit.js'], r'\b(navGrid|navButtonAdd|editGridRow|'
+                r'viewGridRow|delGridRow|GridToForm|FormToGrid)\b'),
+        'filter': (['grid.common.js', 'jqModal.js', 'jqDnR.js',
+                'grid.formedit.js', 'grid.filter.js'],
+                r'\b(searchGrid|jqFilter)\b'),
+        'custom': (['grid.common.js', 'jqModal.js', 'jqDnR.js',
+                'grid.custom.js'], r'\b(filterToolbar|setGroupHeaders|'
+                r'setFrozenColumns|sortGrid|setColProp|GridUnload)\b'),
+        'inlinedit': (['grid.common.js', 'jqModal.js', 'jqDnR.js',
+                'grid.inlinedit.js'],
+                r'\b(editRow|saveRow|restoreRow|addRow|inlineNav)\b'),
+        'celledit': (['grid.common.js', 'jqModal.js', 'jqDnR.js',
+                'grid.celledit.js'],
+                r'"cellEdit": true|\b(editCell|saveCell|restoreCell)\b'),
+        'subgrid': (['grid.subgrid.js'], r'"subGrid": true|'
+                r'\b(expandSubGridRow|collapseSubGridRow|toggleSubGridRow)\b'),
+        'grouping': (['grid.grouping.js'],
+                r'"grouping": true|\b(groupingGroupBy|groupingRemove)\b'),
+        'treegrid': (['grid.treegrid.js'],
+                r'"treeGrid": true|'
+                r'\b(expandNode|collapseNode|addChildNode)\b'),
+        'jqueryui': (['grid.jqueryui.js'], r'"sortable": true|'
+                r'\b(columnChooser|gridResize|sortableRows|gridDnD)\b'),
+    }
+
+    def used_features(self, script):
+        """Return the set of jqgrid_features the jqgrid uses.
+
+        Args:
+            script: string, the javascript of the jqgrid, see generate_script()
+        """
+        features = set(['base'])
+        # navGrid shows the search button unless told not to
+        if isinstance(self.nav_grid_options, dict) and \
+                self.nav_grid_options.get('search', True):
+            features.add('filter')
+        for feature, (modules, pattern) in self.jqgrid_features.items():
+            if pattern and re.search(pattern, script):
+                features.add(feature)
+        return features
+
+    # Tokens of css, for strip_css()
+    css_token = re.compile(r"""(?P<space>\s+)|(?P<comment>/\*.*?\*/)|"""
+            r"""(?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|"""
+            r"""(?P<punctuation>[{};,])|(?P<other>[^\s"'/{};,]+|.)""", re.S)
+
+    @classmethod
+    def strip_css(cls, text):
+        """Return css text without its comments and needless spaces, those
+        around { } ; and , and the last ; of a block.
+        """
+        out = []
+        space = False           # whitespace pending before the next token
+        for match in cls.css_token.finditer(text):
+            kind = match.lastgroup
+            token = match.group(kind)
+            if kind == 'space':
+                space = True
+                continue
+            if kind == 'comment':
+                continue
+            if kind == 'punctuation':
+                if token == '}' and out and out[-1] == ';':
+                    out.pop()
+            elif space and out and out[-1] not in '{};,':
+                out.append(' ')
+            space = False
+            out.append(token)
+        return ''.join(out)
+
+    # Tokens of javascript, for strip_js()
+    js_token = re.compile(r"""(?P<space>\s+)|"""
+            r"""(?P<comment>//[^\n]*|/\*.*?\*/)|"""
+            r"""(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|"""
+            r"""(?P<regex>/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|"""
+            r"""[^/\\\n\[])+/[gimy]*)|"""
+            r"""(?P<word>[\w$.]+)|(?P<other>.)""", re.S)
+    # Tokens after which a / starts a regular expression, not a division
+    js_regex_prefixes = set('(,=:[!&|?{};+-*%<>~^') | set(['return', 'typeof',
+            'case', 'do', 'else', 'in', 'instanceof', 'new', 'delete', 'void',
+            'throw', None])
+
+    @classmethod
+    def strip_js(cls, text):
+        """Return javascript text without its comments and needless spaces.
+
+        A lighter minification than gluon.contrib.minify's: line breaks are
+        kept, except after { ; , and before }, so automatic semicolon
+        insertion is unaffected.
+        """
+        out = []
+        previous = None         # last token written
+        space = None            # whitespace pending before the next token
+        position = 0
+        while position < len(text):
+            match = cls.js_token.match(text, position)
+            kind = match.lastgroup
+            token = match.group(kind)
+            if kind == 'regex' and previous not in cls.js_regex_prefixes:
+                kind, token = 'other', '/'      # a division
+                position += 1
+            else:
+                position = match.end()
+            if kind in ('space', 'comment'):
+                if '\n' in token or space == '\n':
+                    space = '\n'
+                elif previous is not None:
+                    space = ' '
+                continue
+            if space and previous is not None:
+                if space == '\n' and previous[-1] not in '{;,' and \
+                        token != '}':
+                    out.append('\n')
+                elif re.match(r'[\w$]', previous[-1]) and \
+                        re.match(r'[\w$]', token[0]) or \
+                        previous[-1] + token[0] in ('++', '--'):
+                    out.append(' ')
+            space = None
+            out.append(token)
+            previous = token
+        return ''.join(out)
+
+    @classmethod
+    def jqgrid_build(cls, folder, features=None):
+        """Write jqgrid_build_file, a jqGrid made of the modules the features
+        need, minified by gluon.contrib.minify if available, else by
+        strip_js().
+
+        Set custom_jqgrid_build to load it instead of the full
+        jquery.jqGrid.min.js, and build again when a jqgrid uses a new
+        feature. A build not smaller than jquery.jqGrid.min.js, as strip_js()
+        may give when many features are used, is not written, and a previous
+        build is removed, so the full jqGrid is loaded.
+
+        Args:
+            folder: string, the folder of the application, eg: request.folder
+            features: list of jqgrid_features, if None, those used by the
+                jqgrids created since the server started, see grid_features.
+
+        Return:
+            dict, {'features': list, 'modules': list, 'size': bytes of the
+                build, 'full_size': bytes of jquery.jqGrid.min.js, 'used':
+                True if the build is smaller, so written}
+        """
+        if features is None:
+            features = set(['base'])
+            for used in cls.grid_features.values():
+                features.update(used)
+        needed = set()
+        for feature in features:
+            needed.update(cls.jqgrid_features[feature][0])
+        modules = [x for x in cls.jqgrid_modules if x in needed]
+        static = os.path.join(folder, 'static')
+        chunks = ['/*\n* jqGrid 4.3.3 - jQuery Grid, custom build\n'
+                '* Copyright (c) 2008, Tony Tomov, tony@trirand.com\n'
+                '* Dual licensed under the MIT and GPL licenses\n'
+                '* http://www.opensource.org/licenses/mit-license.php\n'
+                '* http://www.gnu.org/licenses/gpl-2.0.html\n'
+                '* Features: %s\n* Modules: %s\n*/\n' % (
+                    '; '.join(sorted(features)), '; '.join(modules))]
+        for module in modules:
+            with open(os.path.join(static, 'jqgrid', 'src', module)) as f:
+                text = f.read()
+            chunks.append(jsmin.jsmin(text) if jsmin else cls.strip_js(text))
+        body = ';\n'.join(chunks[1:])
+        filename = os.path.join(static, cls.jqgrid_build_file)
+        size = len(chunks[0]) + len(body)
+        full_size = os.path.getsize(os.path.join(static, 'jqgrid', 'js',
+                'jquery.jqGrid.min.js'))
+        if size < full_size:
+            temporary = '%s.%s' % (filename, uuid.uuid4().hex)
+            with open(temporary, 'wb') as f:
+                f.write(chunks[0] + body)
+            os.rename(temporary, filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+        return {'features': sorted(features), 'modules': modules,
+                'size': size, 'full_size': full_size,
+                'used': size < full_size}
+
     def __call__(self):
-        return DIV(self.script(), self.list(), self.pager())
+        return DIV(self.script(), self.search_box(), self.list(), self.pager())
 
     def column(self, name):
         """Convenience method used to return the colModel column with the
@@ -327,6 +1184,42 @@ class JqGrid(object):
             orderby: DAL orderby instance, if None, the orderby is determined
                 by the request.vars.sidx and request.vars.sord.
             fields: list of table field names
+
+        Reference columns are sorted by the label of the referenced record,
+        see label_orderby(), or by a denormalized label column, see
+        maintain_label_column().
+
+        If keyset_paging is True and the orderby is determined by a sidx
+        which is a table field, rows are sorted by (sidx, id) and the first
+        and last keys of the page are returned in the userdata. When the
+        client asks for the next, previous or same page, those keys are used
+        to seek to the page, see keyset_data_rows().
+
+        If count_over_window is True, data_rows() is not overridden and the
+        database supports it, the rows and the number of records are fetched
+        with a single query, see data_rows_and_records().
+
+        If count_free is True, the records are only counted on page 1, if
+        record_count_cache is True, and later pages use that cached count.
+        Otherwise one row more than the page size is fetched, to tell if there
+        is a next page, and records and total are open-ended: they include one
+        more page if there are more rows. This suits virtual scrolling, ie
+        jqgrid_options {'scroll': 1}.
+
+        If stream_data is True, the rows may be returned as an iterator
+        instead of a list, see data_stream().
+
+        Searches of the search dialog, or of the filter toolbar with
+        {stringResult: True}, are compiled by search_query().
+
+        If memory_engine is True, data_rows() is not overridden, and the
+        table fits in memory_budget, the rows and the number of records are
+        computed in memory, see memory_data().
+
+        If full_text_fields are set, request.vars.w2p_search matches words
+        in any of them, see search_box(), through an FTS5 index if
+        index_full_text() created one. Without a sort column, the rows are
+        then ranked, best matches first, see full_text_rank().
         """
         request = environment['request']
         page = int(request.vars.page)
@@ -335,8 +1228,17 @@ class JqGrid(object):
         queries = []
         if not fields:
             fields = table.fields
+        if request.vars._search == 'true':
+            # Search dialog, or filter toolbar with {stringResult: True}
+            if request.vars.filters:
+                queries.append(cls.search_query(table, request.vars.filters))
+            elif request.vars.searchField:
+                queries.append(cls.search_query(table, {'groupOp': 'AND',
+                        'rules': [{'field': request.vars.searchField,
+                            'op': request.vars.searchOper,
+                            'data': request.vars.searchString}]}))
         for k, v in request.vars.items():
-            #Only works when filter_toolbar_options != {stringResult:True, ...}
+            # Filter toolbar with {stringResult: False}, the default
             if k in table.fields and v:
                 try:
                     queries.append(cls.filter_query_by_field_type(table[k], v))
@@ -344,32 +1246,280 @@ class JqGrid(object):
                     logging.warn(err)
             else:
                 queries.append(cls.filter_query(table._db, k, v))
-        built_query = reduce(lambda x, y: x & y, [x for x in queries if x],
+        search = request.vars.w2p_search
+        if search and cls.full_text_fields:
+            # Global search box, see search_box()
+            queries.append(cls.full_text_query(table, cls.full_text_fields,
+                    search) or cls.contains_words_query(table,
+                    cls.full_text_fields, search))
+        # Sorted, so the same filters always build the same query string
+        built_query = reduce(lambda x, y: x & y,
+                sorted([x for x in queries if x], key=str),
                 query or table.id > 0)
+        keyset = None
         if orderby is None:
-            if request.vars.sidx in table:
+            if request.vars.sidx in cls.label_sort_columns:
+                # Denormalized label of a reference column
+                orderby = [table[cls.label_sort_columns[request.vars.sidx]]]
+                if cls.keyset_paging:
+                    keyset = orderby[0]
+            elif request.vars.sidx and request.vars.sidx in table and \
+                    cls.sort_references_by_label and \
+                    cls.label_orderby(table[request.vars.sidx]):
+                orderby = cls.label_orderby(table[request.vars.sidx])
+            elif request.vars.sidx and request.vars.sidx in table:
                 orderby = [table[request.vars.sidx]]
+                if cls.keyset_paging:
+                    keyset = table[request.vars.sidx]
+            elif request.vars.sidx in cls.virtual_field_expressions:
+                orderby = [cls.virtual_field_expressions[request.vars.sidx](
+                        table)]
             else:
                 orderby = cls.orderby_for_column(table, request.vars.sidx)
             if orderby and request.vars.sord == 'desc':
                 orderby = [~x for x in orderby]
-
-        rows = cls.data_rows(table, built_query, orderby, limitby, fields)
-        total_records = cls.data_records(table, built_query)
+            if search and cls.full_text_fields and \
+                    request.vars.sidx in (None, '', 'w2p_rank'):
+                # Best matches first
+                orderby = cls.full_text_rank(table, search) or orderby
+
+        if cls.memory_engine and keyset is None and \
+                not cls.overrides_data_rows():
+            result = cls.memory_data(table, built_query, orderby, limitby,
+                    fields)
+            if result is not None:
+                rows, total_records = result
+                total_pages = int(math.ceil(total_records / float(pagesize)))
+                return dict(
+                        total=total_pages,
+                        page=min(page, total_pages),
+                        rows=rows,
+                        records=total_records)
+
+        if cls.count_over_window and not cls.count_free and keyset is None \
+                and not cls.stream_data and \
+                not cls.overrides_data_rows() and \
+                cls.supports_count_over_window(table._db):
+            rows, total_records = cls.data_rows_and_records(
+                    table, built_query, orderby, limitby, fields)
+            if total_records is None:   # no rows on this page, count them
+                total_records = cls.data_records(table, built_query)
+            total_pages = int(math.ceil(total_records / float(pagesize)))
+            return dict(
+                    total=total_pages,
+                    page=min(page, total_pages),
+                    rows=rows,
+                    records=total_records)
+
+        if not cls.count_free or (page == 1 and cls.record_count_cache):
+            # In count_free mode, count once per change of filters or sort
+            total_records, estimated = cls.count_records(table, built_query)
+        else:
+            total_records = cls.cached_records(table, built_query)
+            estimated = False
+        userdata = {}
+        if keyset is not None:
+            rows, keyset_userdata = cls.keyset_data_rows(
+                    environment, table, built_query, keyset, page, pagesize,
+                    None if estimated else total_records, fields,
+                    probe=total_records is None)
+            userdata.update(keyset_userdata)
+        elif total_records is None:
+            rows = cls.data_rows(table, built_query, orderby,
+                    (limitby[0], limitby[1] + 1), fields)
+            userdata['w2p_has_more'] = len(rows) > pagesize
+            rows = rows[:pagesize]
+        elif cls.stream_data and \
+                not cls.overrides_data_rows():
+            rows = cls.iter_data_rows(
+                    table, built_query, orderby, limitby, fields)
+        else:
+            rows = cls.data_rows(table, built_query, orderby, limitby, fields)
+        if total_records is None and not rows and page > 1:
+            # Past the end, offset + 0 rows would overstate the records
+            total_records = cls.data_records(table, built_query)
+        elif total_records is None:
+            # Open-ended, at least one page more if there are more rows
+            total_records = limitby[0] + len(rows) + \
+                    (pagesize if userdata['w2p_has_more'] else 0)
+            estimated = True
+        if estimated:
+            # records and total are estimates, let the client know
+            userdata['w2p_estimated'] = True
         total_pages = int(math.ceil(total_records / float(pagesize)))
-        return dict(
+        result = dict(
                 total=total_pages,
                 page=min(page, total_pages),
                 rows=rows,
                 records=total_records)
+        if userdata:
+            result['userdata'] = userdata
+        return result
+
+    @classmethod
+    def keyset_data_rows(cls, environment, table, query, column, page,
+            pagesize, total_records, fields=None, probe=False):
+        """Return data rows and userdata for the jqgrid using keyset paging.
+
+        The rows are sorted by (column, id). The previous response stored the
+        keys of its first and last rows in the userdata, which the client
+        posts back as request.vars.w2p_keyset. When the requested page is
+        the next, previous or same page, of the same size, the rows are
+        fetched with a "WHERE (column, id) > (key)" query, which is as fast
+        on the last page as on the first one, given an index on (column, id).
+        The last page is fetched in reverse order. Any other page falls back
+        to limitby.
+
+        Args:
+            environment: dict, eg: globals()
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+            column: gluon.dal.Field instance, the sort column
+            page: integer, requested page
+            pagesize: integer, number of rows per page
+            total_records: integer, number of records matching query, or
+                None if it is not known exactly
+            fields: list of field names, if None, table.fields is used.
+            probe: boolean, True to tell if there are rows after the page, in
+                userdata['w2p_has_more'].
+
+        Returns:
+            tuple (rows, userdata), see data_rows()
+        """
+        request = environment['request']
+        descending = request.vars.sord == 'desc'
+        columns = [column] if column is table.id else [column, table.id]
+        signature = hashlib.md5(str(query)).hexdigest()
+        try:
+            previous = json.loads(request.vars.w2p_keyset or '{}')
+        except ValueError:
+            previous = {}
+        if previous.get('sidx') != column.name or \
+                previous.get('sord') != request.vars.sord or \
+                previous.get('query') != signature or \
+                previous.get('rows') != pagesize:
+            previous = {}
+        numeric = [c.type in ('id', 'integer', 'float', 'double') or
+                c.type.startswith(('decimal', 'reference')) for c in columns]
+        for name in ('first', 'last'):
+            try:
+                for value, is_numeric in zip(previous[name], numeric):
+                    if is_numeric:
+                        float(value)        # reject tampered keys
+            except (KeyError, TypeError, ValueError):
+                previous[name] = None
+        last_page = int(math.ceil(total_records / float(pagesize))) \
+                if total_records is not None else None
+
+        # Null keys are not saved below, so a page bounded by a null falls
+        # back to limitby.
+        seek = reverse = None
+        if page == 1:
+            pass
+        elif page == previous.get('page', 0) + 1 and previous.get('last'):
+            seek, reverse = cls.keyset_query(
+                    columns, previous['last'], descending), False
+        elif page == previous.get('page') and previous.get('first'):
+            seek, reverse = cls.keyset_query(
+                    columns, previous['first'], descending, True), False
+        elif page == previous.get('page', 0) - 1 and previous.get('first'):
+            seek, reverse = cls.keyset_query(
+                    columns, previous['first'], not descending), True
+        elif page == last_page:
+            seek, reverse = None, True
+        nullable = not column.notnull and column is not table.id
+        if seek is not None and nullable and \
+                (bool(descending) != bool(reverse)) == \
+                cls.nulls_sort_first(table._db):
+            # Nulls come after any key in this direction, and never match a
+            # comparison
+            seek = seek | (column == None)
+
+        orderby = [~x for x in columns] \
+                if bool(descending) != bool(reverse) else columns
+        if reverse:
+            size = total_records - (page - 1) * pagesize if seek is None \
+                    else pagesize
+            limitby = (0, max(min(size, pagesize), 0))
+        elif seek is not None:
+            limitby = (0, pagesize)
+        else:
+            limitby = (page * pagesize - pagesize, page * pagesize)
+        if probe and not reverse:
+            limitby = (limitby[0], limitby[1] + 1)
+        rows = cls.data_rows(table, query if seek is None else query & seek,
+                orderby, limitby, fields)
+        if reverse:
+            rows.reverse()
+
+        keyset = dict(sidx=column.name, sord=request.vars.sord,
+                query=signature, page=page, rows=pagesize)
+        userdata = dict(w2p_keyset=keyset)
+        if probe:
+            # Paging backwards, there is at least the page we came from
+            userdata['w2p_has_more'] = reverse or len(rows) > pagesize
+            rows = rows[:pagesize]
+        if rows:
+            ids = [rows[0]['id'], rows[-1]['id']]
+            keys = dict((r.id, [r[c.name] for c in columns])
+                for r in table._db(table.id.belongs(ids)).select(*columns))
+            for name, row_id in zip(['first', 'last'], ids):
+                values = keys.get(row_id)
+                if values and values[0] is not None:
+                    keyset[name] = [v if isinstance(v, (int, long, float))
+                            else str(v) for v in values]
+        return rows, userdata
+
+    @staticmethod
+    def nulls_sort_first(db):
+        """Return True if db sorts nulls before any value in ascending
+        order, as SQLite, MySQL and MSSQL do, False if after, as PostgreSQL,
+        Oracle and DB2 do.
+        """
+        return db._adapter.dbengine not in ('postgres', 'oracle', 'db2')
 
     @staticmethod
-    def data_rows(table, query, orderby=None, limitby=None, fields=None):
+    def keyset_query(columns, values, descending=False, inclusive=False):
+        """Return a query selecting the rows after the key in sort order.
+
+        Equivalent to "(a, b) > (x, y)" (or "<" if descending), expanded so
+        it works on every backend and is still able to use an index on a.
+
+        Args:
+            columns: list of gluon.dal.Field instances, eg [sort column, id]
+            values: list of values of the columns, the key
+            descending: boolean, True if columns are sorted descending
+            inclusive: boolean, True to include the key itself
+
+        Returns:
+            gluon.dal.Query instance
+        """
+        column, value = columns[0], values[0]
+        if len(columns) == 1:
+            if descending:
+                return column <= value if inclusive else column < value
+            return column >= value if inclusive else column > value
+        after = JqGrid.keyset_query(columns[1:], values[1:], descending,
+                inclusive)
+        if descending:
+            return (column <= value) & ((column < value) | after)
+        return (column >= value) & ((column > value) | after)
+
+    @classmethod
+    def data_rows(cls, table, query, orderby=None, limitby=None, fields=None):
         """Return data rows for the jqgrid.
 
         Override this method to provide custom data access (eg table joins)
         in a subclass.
 
+        Only the fields needed for the columns are selected, see
+        data_fields(), and only the virtual fields of the columns are
+        computed, see parse_rows(). If raw_rows is True and all columns are
+        table fields, the rows are built from the database tuples, see
+        data_rows_raw().
+        Labels of reference columns are looked up once per page, see
+        reference_labels().
+
         Args:
             table: gluon.dal.Table instance
             query: gluon.dal.Query instance
@@ -381,171 +1531,2183 @@ class JqGrid(object):
             list of dicts,
                 eg [{'id': id1, 'cell': ['col1', 'col2', 'col3'..]},...]
         """
-        rows = []
-        for r in table._db(query).select(limitby=limitby, orderby=orderby):
-            vals = []
-            for f in fields or table.fields:
-                if (f in table and table[f].represent):
-                    vals.append(table[f].represent(r[f]))
-                else:
-                    vals.append(r[f])
-            rows.append(dict(id=r.id, cell=vals))
-        return rows
+        if cls.raw_rows and not [f for f in fields or table.fields
+                if f not in table.fields]:
+            return cls.data_rows_raw(table, query, orderby, limitby, fields)
+        rows = table._db(query).select(*cls.data_fields(table, fields),
+                limitby=limitby, orderby=orderby,
+                processor=cls.parse_rows(table, fields))
+        labels = cls.reference_labels(table, dict((f, [r[f] for r in rows])
+                for f in cls.batched_reference_fields(table, fields)))
+        return [dict(id=r.id, cell=cls.data_cells(table, r, fields, labels))
+                for r in rows]
 
-    @staticmethod
-    def data_records(table, query):
-        """Return the number of records in the data rows for the jqgrid.
+    @classmethod
+    def overrides_data_rows(cls):
+        """Return True if the class overrides data_rows(), whether as a
+        classmethod or a staticmethod.
+        """
+        return getattr(cls.data_rows, '__func__', cls.data_rows) is not \
+                JqGrid.data_rows.__func__
 
-        Override this method to provide a custom method for accessing the
-        number of records in a subclass.
+    # Field types whose database values need no parsing in data_rows_raw()
+    raw_field_types = ('id', 'integer', 'bigint', 'float', 'double')
+
+    @classmethod
+    def data_rows_raw(cls, table, query, orderby=None, limitby=None,
+            fields=None):
+        """Return data rows for the jqgrid, built from database tuples.
+
+        Like data_rows(), except the rows are selected with db.executesql(),
+        so no gluon.dal.Row is built. Values are parsed and represented
+        column by column, and only where needed. Virtual fields are not
+        supported, all fields must be table fields.
+
+        Args:
+            See data_rows().
+
+        Return:
+            See data_rows().
+        """
+        db = table._db
+        names = fields or table.fields
+        sql = db(query)._select(table.id, *[table[f] for f in names],
+                limitby=limitby, orderby=orderby)
+        records = db.executesql(sql)
+        data_row = cls.raw_data_row_function(table, names, records)
+        return [data_row(record) for record in records]
+
+    @classmethod
+    def raw_data_row_function(cls, table, names, records=()):
+        """Return a function converting a database tuple into a data row.
 
         Args:
             table: gluon.dal.Table instance
-            query: gluon.dal.Query instance
+            names: list of field names, the tuple is (id, field1, field2, ..)
+            records: list of tuples, the labels of their reference columns
+                are looked up in advance, see reference_labels().
 
         Return:
-            integer, number of records.
+            function, eg: f((1, 'a', 2)) == {'id': 1, 'cell': ['a', 2]}
         """
-        return int(table._db(query).count())
+        adapter = table._db._adapter
+        adapter.build_parsemap()
+        batched = cls.batched_reference_fields(table, names)
+        labels = cls.reference_labels(table, dict(
+                (f, [adapter.parse_value(r[names.index(f) + 1], table[f].type)
+                    for r in records]) for f in batched))
+        converters = []
+        for i, f in enumerate(names):
+            field = table[f]
+            if field.type in cls.raw_field_types and not field.filter_out \
+                    and not field.represent:
+                continue
+
+            def convert(value, field=field, parse=adapter.parse_value,
+                    labels=labels.get(f)):
+                value = parse(value, field.type)
+                if field.filter_out:
+                    value = field.filter_out(value)
+                if labels is not None:
+                    value = cls.reference_label(field, value, labels)
+                elif field.represent:
+                    value = field.represent(value)
+                return value
+            converters.append((i, convert))
+
+        def data_row(record):
+            cells = list(record[1:])
+            for i, convert in converters:
+                cells[i] = convert(cells[i])
+            return {'id': record[0], 'cell': cells}
+        return data_row
 
-    @staticmethod
-    def filter_query_by_field_type(field, value):
-        """Return a query for filtering results on field by field type.
+    @classmethod
+    def iter_data_rows(cls, table, query, orderby=None, limitby=None,
+            fields=None):
+        """Return an iterator over the data rows for the jqgrid.
+
+        Like data_rows(), except the rows are fetched from the cursor
+        stream_chunk_size at a time, while iterating. The iterator must be
+        consumed before the request ends, see data_stream().
 
         Args:
-            field: gluon.dal.Field instance
-            value: mixed, the value of the field to filter on
+            See data_rows().
 
-        Returns:
-            gluon.dal.Query instance
+        Return:
+            iterator of dicts, see data_rows()
         """
-        if field.type in ('text', 'string'):
-            query = field.startswith(value)
-        elif field.type in ('id', 'integer', 'float', 'double',
-                'date', 'datetime', 'time'):
-            # intentionally not use exact matching
-            # note: startswith() fails
-            query = (field.like(value + '%'))
-        elif field.type.startswith('decimal'):
-            query = (field.like(value + '%'))
-        elif field.type.startswith('list:reference'):
-            query = (field.contains(value))
-        elif field.type.startswith('reference'):
-            query = (field == int(value))
-        elif field.type == 'boolean':
-            query = (field == value)
+        db = table._db
+        adapter = db._adapter
+        names = fields or table.fields
+        raw = cls.raw_rows and not [f for f in names if f not in table.fields]
+        if raw:
+            columns = [table.id] + [table[f] for f in names]
         else:
-            raise NoFilterForFieldType(
-                    'No filtering support for field type {t}' % (field.type))
-        return query
+            columns = cls.data_fields(table, fields)
+            parse = cls.parse_rows(table, fields)
+        # Own cursor, represent() may run queries while this one is open
+        cursor = adapter.connection.cursor()
+        cursor.execute(db(query)._select(*columns, limitby=limitby,
+                orderby=orderby))
+        colnames = [str(c) for c in columns]
+        try:
+            while True:
+                records = cursor.fetchmany(cls.stream_chunk_size)
+                if not records:
+                    break
+                if raw:
+                    data_row = cls.raw_data_row_function(table, names,
+                            records)
+                    for record in records:
+                        yield data_row(record)
+                else:
+                    rows = parse(records, columns, colnames)
+                    labels = cls.reference_labels(table, dict(
+                            (f, [r[f] for r in rows]) for f in
+                            cls.batched_reference_fields(table, fields)))
+                    for r in rows:
+                        yield dict(id=r.id,
+                                cell=cls.data_cells(table, r, fields, labels))
+        finally:
+            cursor.close()
 
-    @staticmethod
-    def filter_query(db, column, value):
-        """Return a query for filtering results
+    @classmethod
+    def compact_data(cls, data, fields):
+        """Return the data with rows as arrays, for a smaller payload.
 
-        Override this method to provide custom filtering in a subclass. See
-        commented sample code below.
+        Each row {'id': id, 'cell': [col1, col2, ..]} becomes
+        [col1, col2, .., id], matching the jsonReader option set by __init__()
+        when compact_rows is True.
+
+        Cells of the dictionary_columns are replaced by an index into a list
+        of the distinct values of the column, sent once in
+        userdata['w2p_dictionary'], eg {'2': ['Books', 'Toys']}, keyed by
+        column position. A beforeProcessing callback decodes them on the
+        client. This pays off for columns with few, repeating values.
 
         Args:
-            db: gluon.dal.Dal instance
-            column: string, jqgrid column name
-            value: mixed, the value of the field to filter on
+            data: dict, as returned by data(), rows may be an iterator.
+            fields: list of field names, the columns of the rows
 
-        Returns:
-            gluon.dal.Query instance
+        Return:
+            dict, data with compacted rows
         """
-        query = None
-        #if column == 'person' and value:
-        #   query = db.person.last_name.startswith(value)
-        #elif column == 'thing' and value:
-        #   ...
-        return query
+        data = dict(data)
+        columns = [i for i, f in enumerate(fields)
+                if f in cls.dictionary_columns]
+        dictionary = dict((str(i), []) for i in columns)
+        indexes = dict((i, {}) for i in columns)
+
+        def compact(row):
+            cells = list(row['cell'])
+            for i in columns:
+                value = cells[i]
+                if value is not None:
+                    if value not in indexes[i]:
+                        indexes[i][value] = len(indexes[i])
+                        dictionary[str(i)].append(value)
+                    cells[i] = indexes[i][value]
+            cells.append(row.get('id'))
+            return cells
+        rows = data.get('rows', [])
+        if isinstance(rows, list):
+            data['rows'] = [compact(row) for row in rows]
+        else:
+            data['rows'] = (compact(row) for row in rows)
+        if columns:
+            # Complete once the rows are consumed, see data_stream()
+            data['userdata'] = dict(data.get('userdata', {}),
+                    w2p_dictionary=dictionary)
+        return data
 
-    @staticmethod
-    def orderby_for_column(table, column):
-        """Return an orderby expression list for suitable for sorting a
-        specific column.
+    @classmethod
+    def compress(cls, environment, body, headers):
+        """Return the body compressed with the best encoding the client
+        accepts, gzip or deflate, and set the headers accordingly.
 
-        Override this method to provide custom sorting in a subclass. Columns
-        with names that do not match a table field name must be handled here
-        for column sorting to work. See commented code below for an example.
+        String bodies shorter than compression_min_size are returned as is.
+        Streamed bodies are compressed chunk by chunk. If
+        compressed_cache_size is set, that many compressed string bodies are
+        kept, keyed by their md5, so a repeated page is not compressed again.
 
         Args:
-            table: gluon.dal.Table instance
-            column: string, jqgrid column name
+            environment: dict, eg: globals()
+            body: string or iterator of strings
+            headers: dict, HTTP headers, updated in place
 
-        Returns:
-            list of gluon.dal.Expression instances
+        Return:
+            string or iterator of strings
         """
-        orderby = None
-        # if column == 'person':
-        #     orderby = [table._db.person.last_name,
-        #             table._db.person.first_name]
-        # elif column == 'phone':
-        #     orderby = [table._db.person.phone]
-        # else:
-        #     logging.warn('No sorting for column %s' % (column))
-        return orderby
+        request = environment['request']
+        headers['Vary'] = 'Accept-Encoding'
+        accepted = {}
+        for item in (request.env.http_accept_encoding or '').split(','):
+            parts = item.strip().split(';')
+            try:
+                quality = float(parts[1].split('=')[1]) if len(parts) > 1 \
+                        else 1.0
+            except (IndexError, ValueError):
+                quality = 0.0
+            accepted[parts[0].strip().lower()] = quality
+        encodings = [x for x in ('gzip', 'deflate') if accepted.get(x, 0) > 0]
+        if not encodings:
+            return body
+        encoding = max(encodings, key=lambda x: accepted[x])
+        wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+
+        if not isinstance(body, str):
+            headers['Content-Encoding'] = encoding
+
+            def compressed_chunks(chunks):
+                compressor = zlib.compressobj(cls.compression_level,
+                        zlib.DEFLATED, wbits)
+                for chunk in chunks:
+                    chunk = compressor.compress(chunk)
+                    if chunk:
+                        yield chunk
+                yield compressor.flush()
+            return compressed_chunks(body)
+
+        if len(body) < cls.compression_min_size:
+            return body
+        headers['Content-Encoding'] = encoding
+        key = (encoding, cls.compression_level, hashlib.md5(body).digest())
+        if cls.compressed_cache_size:
+            with cls.compressed_bodies_lock:
+                compressed = cls.compressed_bodies.pop(key, None)
+                if compressed is not None:      # Move to most recently used
+                    cls.compressed_bodies[key] = compressed
+                    return compressed
+        compressor = zlib.compressobj(cls.compression_level, zlib.DEFLATED,
+                wbits)
+        compressed = compressor.compress(body) + compressor.flush()
+        if cls.compressed_cache_size:
+            with cls.compressed_bodies_lock:
+                cls.compressed_bodies[key] = compressed
+                while len(cls.compressed_bodies) > cls.compressed_cache_size:
+                    cls.compressed_bodies.popitem(last=False)
+        return compressed
 
     @classmethod
-    def cud(cls, environment, table):
-        "Create/update/delete callback, defined by editurl option."
-        request = environment['request']
-        crud = environment['crud']    # Caller must supply proper crud instance
-        # Redirection will interfere form editing. Turn them off.
-        crud.settings.create_next = None
-        crud.settings.update_next = None
-        crud.settings.delete_next = None
-        form = None
-        if request.vars.oper == 'del' and request.vars.id:
-            for del_id in request.vars.id.split(','):
-                crud.delete(table, del_id)
-        elif request.vars.oper in ['edit', 'add'] and request.vars.id:
-            for k, v in request.post_vars.items():
-                if k in table:
-                    # translate value from jqgrid format into web2py format
-                    if table[k].type.startswith('list:'):
-                        request.post_vars[k] = [x for x in v.split(',') if x]
-                    elif table[k].type == 'boolean':
-                        request.post_vars[k] = (v == 'on')
+    def data_stream(cls, data):
+        """Return the data as a JSON encoded stream, for the HTTP body.
 
-            # A dirty hack, so this action will do submit for every visit,
-            # with little cost of losing double-submit-protection, see here:
-            # http://groups.google.com/group/web2py/msg/fa9d5104257d66a6
-            crud.environment.session = None
+        The rows are encoded one at a time into a temporary file, which stays
+        in memory up to stream_spool_size bytes. So neither the list of rows
+        nor the whole JSON string is ever held in memory. Rows have to be
+        encoded before web2py closes the database connection, at the end of
+        the request, hence the temporary file.
 
-            form = crud.update(table,
-                    request.vars.id if request.vars.id != '_empty' else None,
-                    formname=None)      # another magic
+        Args:
+            data: dict, as returned by data(), rows may be an iterator.
 
-            if form.errors:
-                raise HTTP(406,
-                    ',<br />'.join('%s:%s' % (form.table[k].label, v)
-                        for k, v in form.errors.items())
-                    )
-        if not form or not form.errors:
-            cls.cud_callback(environment, table, form)
+        Return:
+            iterator of strings
+        """
+        data = dict(data)
+        rows = data.pop('rows', [])
+        stream = tempfile.SpooledTemporaryFile(max_size=cls.stream_spool_size)
+        stream.write('{"rows": [')
+        for i, row in enumerate(rows):
+            stream.write((', ' if i else '') + json_serializer(row))
+        # The rest after the rows, which may fill in userdata while consumed
+        tail = json_serializer(data)[1:]        # Strip opening brace
+        stream.write('], ' + tail if data else ']}')
+        stream.seek(0)
+        return streamer(stream)
 
     @classmethod
-    def cud_callback(cls, environment, table, form=None):
-        """Callback called after cud update.
+    def data_fields(cls, table, fields=None):
+        """Return the fields to select for the jqgrid columns.
 
-        Intended to be overridden in subclass.
+        These are id, the columns which are table fields, and the fields that
+        virtual field columns depend on, as declared in
+        virtual_field_dependencies, eg:
+            virtual_field_dependencies = {'markup': ['price', 'cost']}
+        Virtual fields without declared dependencies may need any field, then
+        all fields are selected.
+
+        Virtual fields with an SQL equivalent, declared in
+        virtual_field_expressions, are computed by the database instead, eg:
+            virtual_field_expressions = {'markup': lambda t: t.price / t.cost}
+        Their expressions are selected after the fields.
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, if None, table.fields is used.
+
+        Return:
+            list of gluon.dal.Field and gluon.dal.Expression instances
         """
-        pass
+        names = set(['id'])
+        expressions = []
+        for f in fields or table.fields:
+            if f in table.fields:
+                names.add(f)
+            elif f in cls.virtual_field_expressions:
+                expressions.append(cls.virtual_field_expressions[f](table))
+            elif f in cls.virtual_field_dependencies:
+                names.update(cls.virtual_field_dependencies[f])
+            else:
+                names.update(table.fields)
+        return [table[f] for f in table.fields if f in names] + expressions
 
-    def list(self):
-        """Return a HTML table representing jqgrid list."""
-        return TABLE(_id=self.list_table_id)
+    @classmethod
+    def parse_rows(cls, table, fields=None):
+        """Return a select processor building the rows of a page.
 
-    def pager(self):
-        """Return a HTML div representing jqgrid pager."""
-        return DIV(_id=self.pager_div_id)
+        The rows are parsed as the DAL does, except virtual fields, old or new
+        style, are not computed for every row of every select. Only the
+        virtual field columns in fields are computed, once the page is
+        fetched. Those with an SQL equivalent take the value computed by the
+        database, see data_fields().
 
-    def script(self):
-        """Return a HTML script representing jqgrid javascript."""
-        # so user has chance for customizing, between __init__() and script()
-        self.basic_options = dumps(self.jqgrid_options)[1:-1]    # Strip quotes
+        Usage:
+            db(query).select(..., processor=cls.parse_rows(table, fields))
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, if None, table.fields is used.
+
+        Return:
+            function, with the signature of the adapter parse() method
+        """
+        db = table._db
+        adapter = db._adapter
+        tablename = str(table)
+        virtual = [f for f in fields or table.fields if f not in table.fields]
+        # Columns computed by the database go straight into the row
+        expressions = dict((str(cls.virtual_field_expressions[f](table)), f)
+                for f in virtual if f in cls.virtual_field_expressions)
+        virtual = [f for f in virtual if f not in expressions.values()]
+
+        def parse(records, columns, colnames, *args, **kwargs):
+            adapter.build_parsemap()
+            names = []
+            for c in colnames:
+                if c.split('.')[0] == tablename and \
+                        c.split('.')[-1] in table.fields:
+                    names.append(c.split('.')[-1])
+                else:
+                    names.append(expressions.get(c))
+            rows = []
+            for record in records:
+                box = Row()
+                row = Row({tablename: box})
+                for name, column, colname, value in zip(names, columns,
+                        colnames, record):
+                    value = adapter.parse_value(value, column.type)
+                    if name is None:
+                        if not '_extra' in row:
+                            row['_extra'] = Row()
+                        row['_extra'][colname] = value
+                        continue
+                    if getattr(column, 'filter_out', None):
+                        value = column.filter_out(value)
+                    box[name] = value
+                rows.append(row)
+            for f in virtual:
+                for row in rows:
+                    row[tablename][f] = cls.virtual_value(table, row, f)
+            return Rows(db, rows, colnames)
+        return parse
+
+    @classmethod
+    def virtual_value(cls, table, row, name):
+        """Return the value of a virtual field column of a row.
+
+        Args:
+            table: gluon.dal.Table instance
+            row: gluon.dal.Row instance, with the fields of table in
+                row[tablename], as the virtual fields expect.
+            name: string, the virtual field name
+
+        Return:
+            the value, None if name is not a virtual field of table
+        """
+        if name in cls.virtual_field_expressions:
+            return row[str(cls.virtual_field_expressions[name](table))]
+        field = getattr(table, name, None)
+        if isinstance(field, FieldVirtual):
+            return field.f(row)
+        if isinstance(field, FieldLazy):
+            return (field.handler or VirtualCommand)(field.f, row)
+        for virtualfields in table.virtualfields:
+            method = getattr(virtualfields, name, None)
+            if method is None:
+                continue
+            if hasattr(method, '__lazy__'):
+                return VirtualCommand(method, row)
+            virtualfields.__dict__.update(row)
+            return method()
+        return None
+
+    @classmethod
+    def data_rows_and_records(cls, table, query, orderby=None, limitby=None,
+            fields=None):
+        """Return data rows and the number of records for the jqgrid, using
+        a single "SELECT ..., COUNT(*) OVER () ..." query.
+
+        Only use this if supports_count_over_window() is True.
+
+        Args:
+            See data_rows().
+
+        Return:
+            tuple (rows, records), see data_rows() and data_records().
+            records is None if there are no rows in limitby.
+        """
+        total = Expression(table._db, 'COUNT(*) OVER ()', type='integer')
+        columns = cls.data_fields(table, fields)
+        selected = table._db(query).select(*(columns + [total]),
+                limitby=limitby, orderby=orderby,
+                processor=cls.parse_rows(table, fields))
+        records = int(selected[0][total]) if selected else None
+        rows = [r[str(table)] for r in selected]
+        labels = cls.reference_labels(table, dict((f, [r[f] for r in rows])
+                for f in cls.batched_reference_fields(table, fields)))
+        return [dict(id=r.id, cell=cls.data_cells(table, r, fields, labels))
+                for r in rows], records
+
+    @classmethod
+    def memory_store(cls, table):
+        """Return the ColumnStore of table, loading it if need be.
+
+        The store is kept for memory_ttl seconds, and dropped by invalidate(),
+        which cud() calls, so it is reloaded on the next request. With
+        share_data_versions(), it is also reloaded when another process
+        changed the data version of table.
+
+        Args:
+            table: gluon.dal.Table instance
+
+        Return:
+            ColumnStore instance, or None if NumPy is not installed or table
+            does not fit in memory_budget.
+        """
+        if numpy is None:
+            return None
+        key = (table._db._uri_hash, str(table))
+        version = cls.shared_data_version(table)
+        with cls.memory_stores_lock:
+            loaded, loaded_version, store = cls.memory_stores.get(
+                    key, (0, None, None))
+            if time.time() - loaded < cls.memory_ttl and \
+                    loaded_version == version:
+                if store is not None and store.nbytes > cls.memory_budget:
+                    return None         # Loaded for a grid with more budget
+                return store
+            store = None
+            # At least 8 bytes per value, don't load what can't fit
+            if table._db(table.id > 0).count() * len(table.fields) * 8 <= \
+                    cls.memory_budget:
+                store = ColumnStore(table)
+                if store.nbytes > cls.memory_budget:
+                    store = None
+            if store is None:
+                logging.info('Table %s exceeds the memory budget' % table)
+            cls.memory_stores[key] = (time.time(), version, store)
+            return store
+
+    @classmethod
+    def memory_data(cls, table, query, orderby=None, limitby=None,
+            fields=None):
+        """Return data rows and the number of records for the jqgrid,
+        filtered, sorted and sliced in memory, see ColumnStore.
+
+        Args:
+            See data_rows().
+
+        Return:
+            tuple (rows, records), see data_rows() and data_records(), or
+            None if the table is not in memory, or the query, orderby or
+            fields are not supported, eg virtual fields.
+        """
+        names = fields or table.fields
+        store = cls.memory_store(table)
+        if store is None or [f for f in names if f not in store.columns]:
+            return None
+        try:
+            indexes = numpy.nonzero(store.mask(query))[0]
+            if orderby:
+                indexes = store.order(indexes, orderby)
+        except NotImplementedError as err:
+            logging.debug(err)
+            return None
+        if limitby:
+            indexes_page = indexes[limitby[0]:limitby[1]]
+        else:
+            indexes_page = indexes
+        rows = [Row(store.row(i, set(names) | set(['id'])))
+                for i in indexes_page]
+        labels = cls.reference_labels(table, dict((f, [r[f] for r in rows])
+                for f in cls.batched_reference_fields(table, fields)))
+        return [dict(id=r.id, cell=cls.data_cells(table, r, fields, labels))
+                for r in rows], len(indexes)
+
+    @staticmethod
+    def supports_count_over_window(db):
+        """Return True if the database supports "COUNT(*) OVER ()".
+
+        Override this method in a subclass, eg: for MySQL 8.0+.
+
+        Args:
+            db: gluon.dal.DAL instance
+        """
+        engine = db._adapter.dbengine
+        if engine == 'sqlite':
+            return sqlite3.sqlite_version_info >= (3, 25, 0)
+        return engine in ('postgres', 'oracle', 'mssql', 'db2')
+
+    @classmethod
+    def data_cells(cls, table, row, fields=None, labels=None):
+        """Return the jqgrid cell values of a row.
+
+        Args:
+            table: gluon.dal.Table instance
+            row: gluon.dal.Row instance of table
+            fields: list of field names, if None, table.fields is used.
+            labels: dict, {field name: {id: label}}, labels of reference
+                columns, used instead of represent, see reference_labels().
+
+        Return:
+            list, eg ['col1', 'col2', 'col3'..]
+        """
+        vals = []
+        for f in fields or table.fields:
+            if labels and f in labels:
+                vals.append(cls.reference_label(table[f], row[f], labels[f]))
+            elif (f in table.fields and table[f].represent):
+                vals.append(table[f].represent(row[f]))
+            else:
+                vals.append(row[f])
+        return vals
+
+    @classmethod
+    def batched_reference_fields(cls, table, fields=None):
+        """Return the names of the reference and list:reference columns
+        whose labels can be looked up once per page.
+
+        Those are the columns with the represent the DAL sets by default,
+        which looks up every record on its own. Columns with a custom
+        represent are left alone.
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, if None, table.fields is used.
+
+        Return:
+            list of field names
+        """
+        if not cls.batch_reference_labels:
+            return []
+        names = []
+        for f in fields or table.fields:
+            if f not in table.fields or \
+                    cls.referenced_table(table[f]) is None:
+                continue
+            represent = table[f].represent
+            if not represent or getattr(represent, '__name__', None) in \
+                    ('repr_ref', 'list_ref_repr'):
+                names.append(f)
+        return names
+
+    @staticmethod
+    def referenced_table(field):
+        """Return the table referenced by a reference or list:reference
+        field, or None.
+        """
+        for prefix in ('reference ', 'list:reference '):
+            if field.type.startswith(prefix):
+                tablename = field.type[len(prefix):].strip()
+                if tablename in field.db.tables:
+                    return field.db[tablename]
+        return None
+
+    @classmethod
+    def reference_labels(cls, table, values):
+        """Return the labels of referenced records, looked up with one
+        belongs() query per reference column.
+
+        Labels are made by the format of the referenced table, as the DAL
+        does for its default represent.
+
+        Args:
+            table: gluon.dal.Table instance
+            values: dict, {field name: list of values of the column}
+
+        Return:
+            dict, {field name: {id: label}}
+        """
+        labels = {}
+        for f, column in values.items():
+            referenced = cls.referenced_table(table[f])
+            ids = set()
+            for value in column:
+                if isinstance(value, (list, tuple)):
+                    ids.update(value)
+                elif value is not None:
+                    ids.add(value)
+            labels[f] = cls.table_labels(referenced,
+                    referenced._id.belongs(ids)) if ids else {}
+        return labels
+
+    @staticmethod
+    def table_labels(table, query):
+        """Return the labels of the records of table matching query, made by
+        the format of table, as the DAL does for its default represent.
+
+        Args:
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+
+        Return:
+            dict, {id: label}
+        """
+        labels = {}
+        form = getattr(table, '_format', None)
+        columns = [table._id]
+        if isinstance(form, str):
+            columns += [table[x] for x in re.findall(r'%\((\w+)\)', form)
+                    if x in table.fields]
+        elif form:
+            columns = []                # A callable format may use any field
+        for row in table._db(query).select(*columns):
+            key = row[table._id.name]
+            if isinstance(form, str):
+                labels[key] = form % row
+            elif form:
+                labels[key] = form(row)
+            else:
+                labels[key] = key
+        return labels
+
+    @classmethod
+    def label_orderby(cls, field):
+        """Return an orderby sorting a reference field by the label of the
+        referenced record, ie by the fields in the format of the referenced
+        table, eg for things.category, with format '%(name)s':
+            (SELECT r.name FROM category r WHERE r.id = things.category)
+        The subquery joins on the primary key of the referenced table, so it
+        is an index lookup.
+
+        For big tables, a denormalized label column avoids the subquery, see
+        maintain_label_column().
+
+        Args:
+            field: gluon.dal.Field instance
+
+        Return:
+            list of gluon.dal.Expression instances, or None if field is not a
+            reference, or the format of the referenced table is not a string.
+        """
+        if field.type.startswith('list:'):
+            return None
+        referenced = cls.referenced_table(field)
+        form = getattr(referenced, '_format', None)
+        if not isinstance(form, str):
+            return None
+        names = [x for x in re.findall(r'%\((\w+)\)', form)
+                if x in referenced.fields]
+        return [Expression(field.db,
+                '(SELECT w2p_ref.%s FROM %s w2p_ref WHERE w2p_ref.%s = %s)' % (
+                    x, referenced, referenced._id.name, field),
+                type=referenced[x].type) for x in names] or None
+
+    @classmethod
+    def maintain_label_column(cls, table, name, column):
+        """Keep column of table set to the label of the record its reference
+        field name refers to, so the jqgrid can sort by it with an index,
+        see label_sort_columns.
+
+        Labels are set on insert and update of table, and updated when the
+        referenced records are. Existing records are filled in by
+        refresh_label_column().
+
+        Usage in your model:
+            db.define_table('things', ..., Field('category', db.category),
+                Field('category_label', readable=False, writable=False))
+            JqGrid.maintain_label_column(db.things, 'category',
+                'category_label')
+        and on the grid:
+            class ThingsJqGrid(JqGrid):
+                label_sort_columns = {'category': 'category_label'}
+
+        Args:
+            table: gluon.dal.Table instance
+            name: string, name of a reference field of table
+            column: string, name of a string field of table
+        """
+        referenced = cls.referenced_table(table[name])
+
+        def label(value):
+            labels = cls.reference_labels(table, {name: [value]})[name]
+            label = cls.reference_label(table[name], value, labels)
+            return None if label is None else str(label)
+
+        def set_label(fields):
+            if name in fields:
+                fields[column] = label(fields[name])
+
+        # The update may change what its own query matches, so the ids are
+        # selected before it, and kept on its Set
+        attribute = '_jqgrid_label_ids_%s_%s' % (table, column)
+
+        def select_ids(dbset, fields):
+            setattr(dbset, attribute, [row[referenced._id.name]
+                    for row in dbset.select(referenced._id)])
+
+        def update_labels(dbset, fields):
+            for row_id in getattr(dbset, attribute, []):
+                table._db(table[name] == row_id).update(
+                        **{column: label(row_id)})
+        table._before_insert.append(lambda fields: set_label(fields))
+        table._before_update.append(
+                lambda dbset, fields: set_label(fields))
+        referenced._before_update.append(select_ids)
+        referenced._after_update.append(update_labels)
+
+    @classmethod
+    def refresh_label_column(cls, table, name, column):
+        """Set column of all records of table to the label of the record
+        its reference field name refers to, see maintain_label_column().
+        """
+        referenced = cls.referenced_table(table[name])
+        ids = [r[name] for r in table._db(table[name] != None).select(
+                table[name], distinct=True)]
+        labels = cls.reference_labels(table, {name: ids})[name]
+        for value in ids:
+            label = cls.reference_label(table[name], value, labels)
+            table._db(table[name] == value).update(**{column: str(label)})
+
+    @staticmethod
+    def reference_label(field, value, labels):
+        """Return the represented value of a reference or list:reference
+        field, given the labels of the referenced records.
+        """
+        if field.type.startswith('list:'):
+            if not value:
+                return None
+            return ', '.join(str(labels[x]) for x in sorted(set(value))
+                    if x in labels)
+        if value is None:
+            return None
+        return labels.get(value, value)
+
+    @classmethod
+    def select_options(cls, field, blank=True):
+        """Return the options of a select for a reference or list:reference
+        field, as the value string of editoptions or searchoptions.
+
+        Usage in your controller:
+            {'name': 'category', 'stype': 'select', 'edittype': 'select',
+                'editoptions': {'value': JqGrid.select_options(
+                    db.things.category)}}
+
+        Or, for long lists, let the browser fetch them when needed, with
+        {'dataUrl': True}, see select_options_html().
+
+        The options are cached until the referenced table is invalidated, see
+        invalidate(), or for select_options_ttl seconds.
+
+        Args:
+            field: gluon.dal.Field instance
+            blank: boolean, True to start with an empty option
+
+        Return:
+            string, eg: ':;1:Books;2:Music', labels sorted
+        """
+        value = cls.cached_select_options(field)[0]
+        return ':;' + value if blank and value else ':' if blank else value
+
+    @classmethod
+    def select_options_html(cls, field, blank=True):
+        """Return the options of a select for a reference or list:reference
+        field, as the html served to editoptions or searchoptions dataUrl.
+
+        Cached as select_options() is.
+
+        Return:
+            string, eg: '<select><option value="1">Books</option></select>'
+        """
+        html = cls.cached_select_options(field)[1]
+        return '<select>%s%s</select>' % (
+                '<option value=""></option>' if blank else '', html)
+
+    @classmethod
+    def cached_select_options(cls, field):
+        """Return the value string and the html options of the records
+        referenced by field, from select_options_cache.
+
+        The records are selected once per data version of the referenced
+        table, with their id and the fields its format uses.
+
+        Return:
+            tuple, (value string, html options) without a blank option
+        """
+        referenced = cls.referenced_table(field)
+        if referenced is None:
+            raise ValueError('%s is not a reference field' % field)
+        key = (referenced._db._uri_hash, str(referenced))
+        version = cls.data_version(referenced)
+        with cls.select_options_lock:
+            cached = cls.select_options_cache.get(key)
+        if cached and cached[1] == version and \
+                time.time() - cached[0] < cls.select_options_ttl:
+            return cached[2]
+        labels = cls.table_labels(referenced, referenced._id > 0)
+        options = sorted(((str(v), k) for k, v in labels.items()),
+                key=lambda x: (x[0].lower(), x[1]))
+        # jqGrid splits the value string on ';', it can't be escaped
+        value = ';'.join('%s:%s' % (k, v.replace(';', ','))
+                for v, k in options)
+        html = ''.join('<option value="%s">%s</option>' % (k, xmlescape(v))
+                for v, k in options)
+        with cls.select_options_lock:
+            cls.select_options_cache[key] = (time.time(), version,
+                    (value, html))
+        return value, html
+
+    @staticmethod
+    def data_records(table, query):
+        """Return the number of records in the data rows for the jqgrid.
+
+        Override this method to provide a custom method for accessing the
+        number of records in a subclass.
+
+        Args:
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+
+        Return:
+            integer, number of records.
+        """
+        return int(table._db(query).count())
+
+    @classmethod
+    def count_records(cls, table, query):
+        """Return the number of records for the jqgrid, and whether it is
+        an estimate.
+
+        If approximate_records_threshold is set and estimate_records()
+        estimates at least that many records, the estimate is used. Otherwise
+        data_records() is used, and its result is cached if record_count_cache
+        is True. Up to record_count_cache_size counts are cached, the least
+        recently used are dropped first. Cached counts expire after
+        record_count_ttl seconds and are dropped by invalidate(), which cud()
+        calls. With share_data_versions(), they are also dropped when
+        another process changed the data version of table.
+
+        Args:
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+
+        Return:
+            tuple (integer, boolean), number of records and True if the
+            number is an estimate.
+        """
+        if cls.approximate_records_threshold is not None:
+            estimate = cls.estimate_records(table, query)
+            if estimate is not None and \
+                    estimate >= cls.approximate_records_threshold:
+                return estimate, True
+        if not cls.record_count_cache:
+            return cls.data_records(table, query), False
+        count = cls.cached_records(table, query)
+        if count is None:
+            version = cls.shared_data_version(table)
+            count = cls.data_records(table, query)
+            now = time.time()
+            with cls.record_counts_lock:
+                for key, (cached_on, _, _) in cls.record_counts.items():
+                    if now - cached_on >= cls.record_count_ttl:
+                        del cls.record_counts[key]
+                cls.record_counts[(table._db._uri_hash, str(table),
+                        str(query))] = (now, version, count)
+                while len(cls.record_counts) > cls.record_count_cache_size:
+                    cls.record_counts.popitem(last=False)
+        return count, False
+
+    @classmethod
+    def cached_records(cls, table, query):
+        """Return the cached number of records matching query, or None.
+
+        See count_records().
+        """
+        if not cls.record_count_cache:
+            return None
+        key = (table._db._uri_hash, str(table), str(query))
+        with cls.record_counts_lock:
+            cached = cls.record_counts.pop(key, None)
+            if cached:
+                cls.record_counts[key] = cached     # most recently used
+        if cached and time.time() - cached[0] < cls.record_count_ttl and \
+                cached[1] == cls.shared_data_version(table):
+            return cached[2]
+        return None
+
+    @staticmethod
+    def estimate_records(table, query):
+        """Return the estimated number of records matching query.
+
+        The estimate comes from the query planner, so it is cheap, but may be
+        far off. Override this method to provide a better estimate in a
+        subclass.
+
+        Args:
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+
+        Return:
+            integer, or None if no estimate is available.
+        """
+        db = table._db
+        engine = db._adapter.dbengine
+        sql = db(query)._select(table.id).rstrip(';')
+        try:
+            if engine == 'postgres':
+                plan = db.executesql('EXPLAIN ' + sql)
+                match = re.search(r'rows=(\d+)', plan[0][0])
+                return int(match.group(1)) if match else None
+            elif engine == 'mysql':
+                plan = db.executesql('EXPLAIN ' + sql, as_dict=True)
+                return int(plan[0]['rows']) if plan else None
+            elif engine == 'sqlite' and str(query) == str(table.id > 0):
+                # Only the whole table, as counted by the last ANALYZE
+                stats = db.executesql(
+                        'SELECT stat FROM sqlite_stat1 WHERE tbl = ?;',
+                        (str(table),))
+                return int(stats[0][0].split()[0]) if stats else None
+        except Exception as err:    # eg: sqlite_stat1 does not exist
+            logging.debug('No record estimate for %s: %s' % (table, err))
+        return None
+
+    @classmethod
+    def filter_query_by_field_type(cls, field, value):
+        """Return a query for filtering results on field by field type.
+
+        Strings of full_text_fields are matched word by word, see
+        full_text_query(), other strings by prefix.
+        Numbers, dates and times are matched by prefix, as typed, eg '2012-08'
+        matches every date in August 2012. The prefix is translated into
+        range conditions, which can use an index on the field, see
+        numeric_prefix_query() and date_prefix_query(). Values which can't be
+        translated are matched with "LIKE 'value%'".
+
+        Args:
+            field: gluon.dal.Field instance
+            value: mixed, the value of the field to filter on
+
+        Returns:
+            gluon.dal.Query instance
+        """
+        if field.type in ('text', 'string'):
+            query = None
+            if field.name in cls.full_text_fields:
+                query = cls.full_text_query(field.table, [field.name], value)
+            if query is None:
+                query = field.startswith(value)
+        elif field.type in ('id', 'integer', 'bigint', 'float', 'double',
+                'date', 'datetime', 'time') or \
+                field.type.startswith('decimal'):
+            # intentionally not use exact matching
+            # note: startswith() fails
+            if field.type in ('date', 'datetime', 'time'):
+                query = cls.date_prefix_query(field, value)
+            else:
+                query = cls.numeric_prefix_query(field, value,
+                        cls.numeric_filter_digits)
+            if query is None:
+                query = (field.like(value + '%'))
+        elif field.type.startswith('list:reference'):
+            query = (field.contains(value))
+        elif field.type.startswith('reference'):
+            query = (field == int(value))
+        elif field.type == 'boolean':
+            query = (field == value)
+        else:
+            raise NoFilterForFieldType(
+                    'No filtering support for field type {t}' % (field.type))
+        return query
+
+    @classmethod
+    def full_text_table(cls, table, fields=None):
+        """Return the name of the SQLite FTS5 table indexing fields of table,
+        eg things_fts_1a2b3c4d, if index_full_text() created it.
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, if None, full_text_fields
+
+        Return:
+            string, or None if full text search is not available, eg the
+            database is not SQLite or the FTS5 table was not created.
+        """
+        fields = list(fields or cls.full_text_fields)
+        key = (table._db._uri_hash, str(table), tuple(fields))
+        with cls.full_text_tables_lock:
+            if key in cls.full_text_tables:
+                return cls.full_text_tables[key]
+            db = table._db
+            name = cls.full_text_table_name(table, fields)
+            if db._adapter.dbengine != 'sqlite' or not db.executesql(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name = '%s';" % name):
+                name = None
+            cls.full_text_tables[key] = name
+            return name
+
+    @staticmethod
+    def full_text_table_name(table, fields):
+        """Return the name of the FTS5 table indexing fields of table, which
+        is distinct for each set of fields, eg things_fts_1a2b3c4d.
+        """
+        return '%s_fts_%s' % (table,
+                hashlib.md5(','.join(fields)).hexdigest()[:8])
+
+    @classmethod
+    def index_full_text(cls, table, fields=None):
+        """Create the SQLite FTS5 table indexing fields of table, unless it
+        exists, so the jqgrid can search them, see full_text_query().
+
+        The FTS5 table is an external content table, its content is that of
+        table. It is kept in sync by triggers on table, so inserts, updates
+        and deletes made outside of the jqgrid are indexed too. Each set of
+        fields has its own FTS5 table, so grids searching different fields
+        of a table don't share one. Drop the FTS5 table and its triggers by
+        hand once no grid searches its fields.
+
+        Usage in your model:
+            ThingsJqGrid.index_full_text(db.things)
+        where:
+            class ThingsJqGrid(JqGrid):
+                full_text_fields = ['name', 'owner']
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, if None, full_text_fields
+
+        Return:
+            string, the name of the FTS5 table, or None if full text search
+            is not available, eg the database is not SQLite or SQLite lacks
+            FTS5.
+        """
+        fields = list(fields or cls.full_text_fields)
+        key = (table._db._uri_hash, str(table), tuple(fields))
+        with cls.full_text_tables_lock:
+            if cls.full_text_tables.get(key):
+                return cls.full_text_tables[key]
+            db = table._db
+            name = None
+            if db._adapter.dbengine == 'sqlite':
+                name = cls.full_text_table_name(table, fields)
+                try:
+                    cls.create_full_text_table(table, name, fields)
+                except Exception as err:
+                    logging.warn('No full text search on %s: %s' % (
+                            table, err))
+                    db.rollback()
+                    name = None
+            cls.full_text_tables[key] = name
+            return name
+
+    @staticmethod
+    def create_full_text_table(table, name, fields):
+        """Create the FTS5 table name, indexing fields of table, and the
+        triggers keeping it in sync, unless they exist. See
+        index_full_text().
+        """
+        db = table._db
+        if db.executesql('PRAGMA table_info("%s");' % name):
+            return
+        columns = ', '.join(fields)
+        old = ', '.join('old.%s' % f for f in fields)
+        new = ', '.join('new.%s' % f for f in fields)
+        statements = [
+            'CREATE VIRTUAL TABLE {fts} USING fts5({columns}, '
+                "content='{table}', content_rowid='id');",
+            "INSERT INTO {fts}({fts}) VALUES('rebuild');",
+            'DROP TRIGGER IF EXISTS {fts}_ai;',
+            'DROP TRIGGER IF EXISTS {fts}_ad;',
+            'DROP TRIGGER IF EXISTS {fts}_au;',
+            'CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN '
+                'INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); '
+                'END;',
+            'CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN '
+                "INSERT INTO {fts}({fts}, rowid, {columns}) "
+                "VALUES ('delete', old.id, {old}); END;",
+            'CREATE TRIGGER {fts}_au AFTER UPDATE ON {table} BEGIN '
+                "INSERT INTO {fts}({fts}, rowid, {columns}) "
+                "VALUES ('delete', old.id, {old}); "
+                'INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); '
+                'END;',
+            ]
+        for statement in statements:
+            db.executesql(statement.format(fts=name, table=table,
+                    columns=columns, old=old, new=new))
+        db.commit()
+
+    @staticmethod
+    def full_text_match(fields, value):
+        """Return the FTS5 MATCH expression for the words of value, as
+        prefixes, in any of fields, eg for 'red ca':
+            {name owner} : ("red"* "ca"*)
+
+        Return:
+            string, or None if value has no words
+        """
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        words = re.findall(r'\w+', value, re.UNICODE)
+        if not words:
+            return None
+        return ('{%s} : (%s)' % (' '.join(fields),
+                ' '.join('"%s"*' % w for w in words))).encode('utf8')
+
+    @classmethod
+    def full_text_query(cls, table, fields, value):
+        """Return a query matching the rows of table with all the words of
+        value, as word prefixes, in any of fields, using the FTS5 index.
+
+        Args:
+            table: gluon.dal.Table instance
+            fields: list of field names, among full_text_fields
+            value: string, as typed, eg 'red ca'
+
+        Return:
+            gluon.dal.Query instance, or None if full text search is not
+            available or value has no words.
+        """
+        match = cls.full_text_match(fields, value)
+        name = cls.full_text_table(table) if match else None
+        if not name:
+            return None
+        return table.id.belongs('SELECT rowid FROM %s WHERE %s MATCH %s;' % (
+                name, name, table._db._adapter.represent(match, 'string')))
+
+    @classmethod
+    def full_text_rank(cls, table, value):
+        """Return an orderby sorting the rows matching the words of value in
+        full_text_fields, best matches first, see full_text_query().
+
+        Return:
+            list of gluon.dal.Expression instances, or None
+        """
+        match = cls.full_text_match(cls.full_text_fields, value)
+        name = cls.full_text_table(table) if match else None
+        if not name:
+            return None
+        return [Expression(table._db, '(SELECT rank FROM %s WHERE %s MATCH %s '
+                'AND rowid = %s)' % (name, name,
+                    table._db._adapter.represent(match, 'string'), table.id),
+                type='double'), table.id]
+
+    @staticmethod
+    def contains_words_query(table, fields, value):
+        """Return a query matching the rows of table with all the words of
+        value in any of fields, without a full text index.
+        """
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        words = [w.encode('utf8') for w in re.findall(r'\w+', value,
+                re.UNICODE)]
+        if not words:
+            return None
+        return reduce(lambda x, y: x & y, [
+                reduce(lambda x, y: x | y, [table[f].contains(w)
+                    for f in fields]) for w in words])
+
+    @staticmethod
+    def numeric_prefix_query(field, value, digits=12):
+        """Return a query matching the numbers of field starting with value.
+
+        As "field LIKE 'value%'", but with range conditions, eg for '12':
+            (field >= 12 AND field < 13) OR (field >= 120 AND field < 130)
+            OR ... up to numbers of the given digits.
+        A value with a decimal point is a single range, eg for '1.5':
+            field >= 1.5 AND field < 1.6
+
+        Args:
+            field: gluon.dal.Field instance, of a numeric type
+            value: string, the prefix
+            digits: integer, numbers with more digits are not matched
+
+        Returns:
+            gluon.dal.Query instance, or None if value is not a number prefix
+        """
+        match = re.match(r'^(-?)(0|[1-9]\d*)?(\.\d*)?$', value.strip())
+        if not match or not (match.group(2) or match.group(3) is None):
+            return None
+        negative = match.group(1) == '-'
+        if not match.group(2):              # Just a sign
+            return field < 0 if negative else None
+        fraction = match.group(3) or ''
+        integral = field.type in ('id', 'integer', 'bigint')
+        if integral and fraction:
+            return None
+        start = decimal.Decimal(match.group(2) + (fraction.rstrip('.') or ''))
+        step = decimal.Decimal(1).scaleb(-len(fraction[1:]))
+        ranges = [(start, start + step)]
+        if not fraction and start:          # More digits may follow
+            for i in range(len(match.group(2)), digits):
+                ranges.append((ranges[-1][0] * 10, ranges[-1][1] * 10))
+        convert = decimal.Decimal if field.type.startswith('decimal') else \
+                int if integral else float
+        queries = []
+        for low, high in ranges:
+            if negative:
+                queries.append((field > convert(-high)) &
+                        (field <= convert(-low)))
+            else:
+                queries.append((field >= convert(low)) &
+                        (field < convert(high)))
+        return reduce(lambda x, y: x | y, queries)
+
+    @staticmethod
+    def date_prefix_query(field, value):
+        """Return a query matching the dates or times of field starting with
+        value.
+
+        As "field LIKE 'value%'", but with range conditions, eg for '2012-08':
+            field >= 2012-08-01 AND field < 2012-09-01
+
+        Args:
+            field: gluon.dal.Field instance, of type date, datetime or time
+            value: string, the prefix, eg '2012-0', '2012-08-15 1', '13:3'
+
+        Returns:
+            gluon.dal.Query instance, or None if value is not a prefix of a
+            valid date or time.
+        """
+        template = {'date': 'YYYY-MM-DD', 'datetime': 'YYYY-MM-DD hh:mm:ss',
+                'time': 'hh:mm:ss'}[field.type]
+        value = value.strip()
+        if not value or len(value) > len(template):
+            return None
+        for char, expected in zip(value, template):
+            if char.isdigit() != expected.isalpha() or \
+                    (not char.isdigit() and char != expected):
+                return None
+        limits = {'Y': (1, 9999), 'M': (1, 12), 'D': (1, 31), 'h': (0, 23),
+                'm': (0, 59), 's': (0, 59)}
+        units = []          # Given parts of the template, eg ['Y', 'M']
+        low = []            # Lowest value of each given part
+        high = None         # Highest value of the last given part
+        for part in re.finditer(r'(\w)\1*', template):
+            digits = value[part.start():part.end()]
+            if not digits:
+                break
+            unit, width = part.group(1), len(part.group(0))
+            first, last = limits[unit]
+            if unit == 'D':
+                last = calendar.monthrange(low[0], low[1])[1]
+            units.append(unit)
+            low.append(max(first, int(digits.ljust(width, '0'))))
+            high = min(last, int(digits.ljust(width, '9')))
+            if low[-1] > high:
+                return None
+            if len(digits) < width:
+                break
+        names = dict(Y='year', M='month', D='day', h='hour', m='minute',
+                s='second')
+        start = datetime.datetime(2000, 1, 1).replace(
+                **dict((names[u], x) for u, x in zip(units, low)))
+        # End is just after the last given part, at its highest value
+        end = start.replace(**{names[units[-1]]: high})
+        if units[-1] == 'Y':
+            end = end.replace(year=end.year + 1) if end.year < 9999 else None
+        elif units[-1] == 'M':
+            end = end.replace(year=end.year + 1, month=1) \
+                    if end.month == 12 else end.replace(month=end.month + 1)
+        else:
+            end += datetime.timedelta(**{dict(D='days', h='hours',
+                    m='minutes', s='seconds')[units[-1]]: 1})
+        if field.type == 'date':
+            start, end = start.date(), end and end.date()
+        elif field.type == 'time':
+            end = end.time() if end.date() == start.date() else None
+            start = start.time()
+        query = field >= start
+        if end is not None:
+            query = query & (field < end)
+        return query
+
+    @staticmethod
+    def filter_query(db, column, value):
+        """Return a query for filtering results
+
+        Override this method to provide custom filtering in a subclass. See
+        commented sample code below.
+
+        Args:
+            db: gluon.dal.Dal instance
+            column: string, jqgrid column name
+            value: mixed, the value of the field to filter on
+
+        Returns:
+            gluon.dal.Query instance
+        """
+        query = None
+        #if column == 'person' and value:
+        #   query = db.person.last_name.startswith(value)
+        #elif column == 'thing' and value:
+        #   ...
+        return query
+
+    @classmethod
+    def search_query(cls, table, filters):
+        """Return a query for a jqgrid search, as posted in
+        request.vars.filters, eg:
+            {"groupOp": "AND",
+             "rules": [{"field": "price", "op": "ge", "data": "10"}],
+             "groups": [{"groupOp": "OR", "rules": [...], "groups": []}]}
+
+        Groups nest, and their rules and groups are joined by AND or OR.
+        Operators are eq, ne, lt, le, gt, ge, bw (begins with), bn, ew (ends
+        with), en, cn (contains), nc, in, ni (in, not in, a comma separated
+        list), nu (is null) and nn. Rules on unknown fields or with invalid
+        values are left out.
+
+        Compiled queries are kept as SQL, keyed by the search in canonical
+        form, up to search_cache_size, so a repeated search is neither parsed
+        nor built again.
+
+        Args:
+            table: gluon.dal.Table instance
+            filters: string, JSON, or dict
+
+        Returns:
+            gluon.dal.Query instance, or None
+        """
+        try:
+            search = cls.canonical_search(json.loads(filters)
+                    if isinstance(filters, basestring) else filters)
+        except (ValueError, TypeError, AttributeError, KeyError) as err:
+            logging.warn('Invalid jqgrid search %r: %s' % (filters, err))
+            return None
+        if search is None:
+            return None
+        key = (table._db._uri_hash, str(table), cls.__name__, search)
+        with cls.compiled_searches_lock:
+            sql = cls.compiled_searches.pop(key, None)
+            if sql is not None:         # Move to most recently used
+                cls.compiled_searches[key] = sql
+        if sql is None:
+            query = cls.compile_search(table, search)
+            sql = table._db._adapter.expand(query) if query else ''
+            if cls.search_cache_size:
+                with cls.compiled_searches_lock:
+                    cls.compiled_searches[key] = sql
+                    while len(cls.compiled_searches) > cls.search_cache_size:
+                        cls.compiled_searches.popitem(last=False)
+        return Query(table._db, sql) if sql else None
+
+    @staticmethod
+    def canonical_search(group):
+        """Return a jqgrid search group in canonical form, a hashable tuple:
+            (group_op, ((field, op, data), ...), (group, ...))
+        Rules and groups are sorted, so the same search always has the same
+        form. Empty groups are dropped.
+
+        Return:
+            tuple, or None if the group has no rules.
+        """
+        group_op = 'OR' if str(group.get('groupOp', 'AND')).upper() == 'OR' \
+                else 'AND'
+        rules = tuple(sorted(set((str(r['field']), str(r['op']).lower(),
+                unicode(r.get('data', '') or '').encode('utf8'))
+                for r in group.get('rules') or [])))
+        groups = tuple(sorted(set(x for x in (JqGrid.canonical_search(g)
+                for g in group.get('groups') or []) if x is not None)))
+        if not rules and not groups:
+            return None
+        return (group_op, rules, groups)
+
+    @classmethod
+    def compile_search(cls, table, search):
+        """Return the query of a search in canonical form, see
+        canonical_search().
+        """
+        group_op, rules, groups = search
+        queries = [cls.search_rule_query(table, *rule) for rule in rules] + \
+                [cls.compile_search(table, group) for group in groups]
+        queries = [x for x in queries if x is not None]
+        if not queries:
+            return None
+        if group_op == 'OR':
+            return reduce(lambda x, y: x | y, queries)
+        return reduce(lambda x, y: x & y, queries)
+
+    @classmethod
+    def search_rule_query(cls, table, field, op, data):
+        """Return the query of a jqgrid search rule, see search_query().
+
+        Args:
+            table: gluon.dal.Table instance
+            field: string, the field name, or a virtual field with an SQL
+                equivalent, see virtual_field_expressions.
+            op: string, the jqgrid operator, eg 'eq'
+            data: string, the value searched for
+
+        Returns:
+            gluon.dal.Query instance, or None
+        """
+        if field in table.fields:
+            column = table[field]
+        elif field in cls.virtual_field_expressions:
+            column = cls.virtual_field_expressions[field](table)
+        else:
+            logging.warn('No search on unknown field %s' % field)
+            return None
+        if op == 'nu':
+            return column == None
+        if op == 'nn':
+            return column != None
+        try:
+            if op in ('in', 'ni'):
+                values = [cls.search_value(column.type, x.strip())
+                        for x in data.split(',')]
+                query = column.belongs(values)
+                return query if op == 'in' else ~query
+            if op in ('bw', 'bn', 'ew', 'en', 'cn', 'nc'):
+                if column.type.startswith('list:'):
+                    query = column.contains(cls.search_value(
+                            column.type[5:], data))
+                elif op in ('bw', 'bn') and isinstance(column, Field) and \
+                        column.type not in ('string', 'text'):
+                    query = cls.filter_query_by_field_type(column, data)
+                else:
+                    query = column.like({'b': '%s%%', 'e': '%%%s',
+                            'c': '%%%s%%', 'n': '%%%s%%'}[op[0]] % data)
+                return ~query if op in ('bn', 'en', 'nc') else query
+            value = cls.search_value(column.type, data)
+        except (ValueError, TypeError, decimal.InvalidOperation,
+                NoFilterForFieldType) as err:
+            logging.warn('No search on %s %s %r: %s' % (field, op, data, err))
+            return None
+        if op == 'eq':
+            return column == value
+        if op == 'ne':
+            return column != value
+        if op == 'lt':
+            return column < value
+        if op == 'le':
+            return column <= value
+        if op == 'gt':
+            return column > value
+        if op == 'ge':
+            return column >= value
+        logging.warn('No search operator %s' % op)
+        return None
+
+    @staticmethod
+    def search_value(field_type, data):
+        """Return data, a string, converted to the python type of a field
+        type, eg: search_value('integer', '12') == 12.
+
+        Raises ValueError if data is not a valid value.
+        """
+        if field_type in ('id', 'integer', 'bigint') or \
+                field_type.startswith('reference'):
+            return int(data)
+        if field_type in ('float', 'double'):
+            return float(data)
+        if field_type.startswith('decimal'):
+            return decimal.Decimal(data)
+        if field_type == 'boolean':
+            return data.lower() in ('true', 't', 'yes', 'on', '1')
+        if field_type == 'date':
+            return datetime.datetime.strptime(data, '%Y-%m-%d').date()
+        if field_type == 'datetime':
+            return datetime.datetime.strptime(data.replace('T', ' ')[:19],
+                    '%Y-%m-%d %H:%M:%S' if len(data) > 16 else
+                    '%Y-%m-%d %H:%M')
+        if field_type == 'time':
+            return datetime.datetime.strptime(data, '%H:%M:%S' if
+                    data.count(':') > 1 else '%H:%M').time()
+        return data
+
+    @staticmethod
+    def orderby_for_column(table, column):
+        """Return an orderby expression list for suitable for sorting a
+        specific column.
+
+        Override this method to provide custom sorting in a subclass. Columns
+        with names that do not match a table field name must be handled here
+        for column sorting to work. See commented code below for an example.
+
+        Args:
+            table: gluon.dal.Table instance
+            column: string, jqgrid column name
+
+        Returns:
+            list of gluon.dal.Expression instances
+        """
+        orderby = None
+        # if column == 'person':
+        #     orderby = [table._db.person.last_name,
+        #             table._db.person.first_name]
+        # elif column == 'phone':
+        #     orderby = [table._db.person.phone]
+        # else:
+        #     logging.warn('No sorting for column %s' % (column))
+        return orderby
+
+    @classmethod
+    def cud(cls, environment, table):
+        "Create/update/delete callback, defined by editurl option."
+        request = environment['request']
+        crud = environment['crud']    # Caller must supply proper crud instance
+        # Redirection will interfere form editing. Turn them off.
+        crud.settings.create_next = None
+        crud.settings.update_next = None
+        crud.settings.delete_next = None
+        form = None
+        ids = None
+        if request.vars.oper == 'del' and request.vars.id:
+            try:
+                ids = [int(x) for x in request.vars.id.split(',')]
+            except ValueError:
+                raise HTTP(400, 'Invalid record id')
+            if cls.bulk_delete:
+                ids = cls.delete_records(environment, table, ids)
+            else:
+                for del_id in ids:
+                    crud.delete(table, del_id)
+        elif request.vars.oper in ['edit', 'add'] and request.vars.id:
+            for k, v in request.post_vars.items():
+                if k in table:
+                    # translate value from jqgrid format into web2py format
+                    if table[k].type.startswith('list:'):
+                        request.post_vars[k] = [x for x in v.split(',') if x]
+                    elif table[k].type == 'boolean':
+                        request.post_vars[k] = (v == 'on')
+
+            # A dirty hack, so this action will do submit for every visit,
+            # with little cost of losing double-submit-protection, see here:
+            # http://groups.google.com/group/web2py/msg/fa9d5104257d66a6
+            crud.environment.session = None
+
+            form = crud.update(table,
+                    request.vars.id if request.vars.id != '_empty' else None,
+                    formname=None)      # another magic
+
+            if form.errors:
+                raise HTTP(406,
+                    ',<br />'.join('%s:%s' % (form.table[k].label, v)
+                        for k, v in form.errors.items())
+                    )
+            ids = [form.vars.id]
+        if not form or not form.errors:
+            cls.invalidate(table)
+            # Overrides predating the ids argument are called without it
+            spec = inspect.getargspec(cls.cud_callback)
+            if spec.keywords or 'ids' in spec.args:
+                cls.cud_callback(environment, table, form, ids=ids)
+            else:
+                cls.cud_callback(environment, table, form)
+
+    @classmethod
+    def delete_records(cls, environment, table, ids):
+        """Delete the records of table with ids, in one statement, as
+        crud.delete() would one by one: checking the crud permissions, see
+        has_permissions(), and calling the crud delete_onvalidation and
+        delete_onaccept callbacks.
+
+        Ids missing from table are left out. The select and the delete run
+        in the transaction of the request, committed or rolled back as one.
+
+        Args:
+            environment: dict, eg: globals()
+            table: gluon.dal.Table instance
+            ids: list of record ids, integers or strings
+
+        Return:
+            list of the ids of the records deleted, integers
+        """
+        crud = environment['crud']
+        try:
+            ids = sorted(set(int(x) for x in ids))
+        except ValueError:
+            raise HTTP(400, 'Invalid record id')
+        if not cls.has_permissions(crud, 'delete', table, ids):
+            redirect(crud.settings.auth.settings.on_failed_authorization)
+        settings = crud.settings
+        query = table._id.belongs(ids)
+        if settings.delete_onvalidation or settings.delete_onaccept:
+            records = table._db(query).select()
+        else:
+            records = table._db(query).select(table._id)
+        for record in records:
+            callback(settings.delete_onvalidation, record)
+        deleted = [record[table._id.name] for record in records]
+        if deleted:
+            table._db(table._id.belongs(deleted)).delete()
+            for record in records:
+                callback(settings.delete_onaccept, record, table._tablename)
+            if environment.get('session') is not None:
+                environment['session'].flash = crud.messages.record_deleted
+        return deleted
+
+    @staticmethod
+    def has_permissions(crud, name, table, ids):
+        """Return True if crud.has_permission() is True for each of the
+        records of table with ids.
+
+        With auth, the memberships of the user and the permissions of all
+        the records are selected at once, where crud.has_permission() would
+        query them record by record. A Crud subclass overriding
+        has_permission() is asked record by record.
+
+        Args:
+            crud: gluon.tools.Crud instance
+            name: string, eg 'delete'
+            table: gluon.dal.Table instance
+            ids: list of record ids, integers
+        """
+        auth = crud.settings.auth
+        if not auth:
+            return True
+        if getattr(type(crud).has_permission, '__func__', None) is not \
+                Crud.has_permission.__func__:
+            return not [x for x in ids
+                    if not crud.has_permission(name, table, x)]
+        # The groups of Auth.has_permission(), including everybody's
+        groups = set([auth.settings.everybody_group_id]) \
+                if auth.settings.everybody_group_id else set()
+        if auth.user:
+            membership = auth.table_membership()
+            groups.update(r.group_id for r in auth.db(
+                    membership.user_id == auth.user.id).select(
+                    membership.group_id))
+        else:
+            groups.add(None)
+        permission = auth.table_permission()
+        required = {}           # record id, 0 for any: group ids
+        for row in auth.db((permission.name == name) &
+                (permission.table_name == str(table)) &
+                permission.record_id.belongs(set(ids) | set([0]))).select(
+                permission.record_id, permission.group_id):
+            required.setdefault(row.record_id, set()).add(row.group_id)
+        for record_id in ids:
+            if auth.user:
+                auth.log_event(auth.messages.has_permission_log,
+                        dict(user_id=auth.user.id, name=name,
+                            table_name=str(table), record_id=record_id))
+            if not groups & (required.get(record_id, set()) |
+                    required.get(0, set())):
+                return False
+        return True
+
+    @classmethod
+    def invalidate(cls, table):
+        """Forget everything cached about the data of table.
+
+        Called by cud(). Call it after modifying table outside of the jqgrid,
+        eg: JqGrid.invalidate(db.things), or see watch_table().
+        """
+        with cls.record_counts_lock:
+            for key in cls.record_counts.keys():
+                if key[:2] == (table._db._uri_hash, str(table)):
+                    del cls.record_counts[key]
+        with cls.data_versions_lock:
+            key = (table._db._uri_hash, str(table))
+            cls.data_versions[key] = cls.data_versions.get(key, 0) + 1
+        versions = cls.shared_versions.get(table._db._uri_hash)
+        if versions is not None:
+            # In the transaction of the change, so committed with it
+            if not versions._db(versions.table_name == str(table)).update(
+                    version=versions.version + 1):
+                versions.insert(table_name=str(table), version=1)
+        with cls.memory_stores_lock:
+            cls.memory_stores.pop((table._db._uri_hash, str(table)), None)
+        with cls.select_options_lock:
+            cls.select_options_cache.pop((table._db._uri_hash, str(table)),
+                    None)
+        for cache in list(cls.page_caches):
+            cache.clear('^%s:' % re.escape('jqgrid-page:%s:%s' % (
+                    table._db._uri_hash, table)))
+
+    @classmethod
+    def watch_table(cls, table):
+        """Call invalidate() after every insert, update or delete on table,
+        also those made outside of the jqgrid through the DAL.
+
+        Usage in your model:
+            JqGrid.watch_table(db.things)
+        """
+        key = (table._db._uri_hash, str(table))
+        if key in cls.watched_tables:
+            return
+        cls.watched_tables.add(key)
+        table._after_insert.append(lambda *args: cls.invalidate(table))
+        table._after_update.append(lambda *args: cls.invalidate(table))
+        table._after_delete.append(lambda *args: cls.invalidate(table))
+
+    @classmethod
+    def share_data_versions(cls, db, tablename='jqgrid_data_version'):
+        """Keep the data versions of the tables of db in a table of db, so
+        that every process, on every host, sees the invalidate() calls of
+        the others, see data_version().
+
+        Usage in your model:
+            JqGrid.share_data_versions(db)
+
+        Args:
+            db: gluon.dal.DAL instance
+            tablename: string, name of the table of versions, defined if
+                need be
+
+        Return:
+            gluon.dal.Table instance, the table of versions
+        """
+        if tablename not in db.tables:
+            db.define_table(tablename,
+                    Field('table_name', length=128, notnull=True,
+                        unique=True),
+                    Field('version', 'integer', notnull=True, default=0))
+        cls.shared_versions[db._uri_hash] = db[tablename]
+        return db[tablename]
+
+    @classmethod
+    def shared_data_version(cls, table):
+        """Return the data version of table read from the table of versions,
+        or None if share_data_versions() was not called for its db.
+
+        Caches of this process check it, as invalidate() only drops them in
+        the process where it runs.
+        """
+        versions = cls.shared_versions.get(table._db._uri_hash)
+        if versions is None:
+            return None
+        row = versions._db(versions.table_name == str(table)).select(
+                versions.version, limitby=(0, 1)).first()
+        return 'db-%d' % (row.version if row else 0)
+
+    @classmethod
+    def data_version(cls, table):
+        """Return the data version of table, which changes on invalidate().
+
+        If share_data_versions() was called for the db of table, the version
+        is read from the table of versions, which every process updates.
+        Otherwise versions are kept per process: a process doesn't see the
+        invalidate() calls of another, so its version also changes every
+        data_version_ttl seconds, which bounds how long it answers 304 or
+        serves a cached page for data another process changed. The process
+        is part of such a version, so it is never mistaken for one of
+        another process.
+
+        Args:
+            table: gluon.dal.Table instance
+
+        Return:
+            string
+        """
+        version = cls.shared_data_version(table)
+        if version is not None:
+            return version
+        with cls.data_versions_lock:
+            version = cls.data_versions.get(
+                    (table._db._uri_hash, str(table)), 0)
+        if cls.data_version_ttl:
+            return '%s-%d-%d' % (cls.data_version_prefix, version,
+                    int(time.time() // cls.data_version_ttl))
+        return '%s-%d' % (cls.data_version_prefix, version)
+
+    @classmethod
+    def data_etag(cls, environment, table, query=None, fields=None):
+        """Return the ETag of the jqgrid data requested.
+
+        It is derived from the data versions of table and of the tables its
+        reference columns point to, and from the request vars, except nd,
+        jqgrid's cache buster.
+
+        Args:
+            environment: dict, eg: globals()
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+            fields: list of field names, if None, table.fields is used.
+
+        Return:
+            string, a weak ETag, which holds whatever the Content-Encoding
+        """
+        request = environment['request']
+        tables = [table] + [table._db[table[f].type.split()[1].split('.')[0]]
+                for f in fields or table.fields if f in table.fields and
+                table[f].type.startswith(('reference ', 'list:reference '))]
+        signature = hashlib.md5(repr((
+                [(str(t), cls.data_version(t)) for t in tables],
+                str(query), fields,
+                sorted((k, v) for k, v in request.vars.items() if k != 'nd'),
+                ))).hexdigest()
+        return 'W/"%s"' % signature
+
+    @classmethod
+    def page_cache_key(cls, environment, table, query=None, fields=None):
+        """Return the page_cache key of the jqgrid data requested.
+
+        The key holds the data_etag(), so it changes with the data version of
+        table, or of a table it references, and with the query, the filters,
+        the sort and the page.
+        """
+        return 'jqgrid-page:%s:%s:%s:%s' % (table._db._uri_hash, table,
+                cls.__name__, cls.data_etag(environment, table, query,
+                fields)[3:-1])
+
+    @classmethod
+    def cached_page(cls, environment, table, query, fields, render):
+        """Return the body of the jqgrid data requested, from page_cache.
+
+        page_cache is one of:
+            None: no caching, the default, set it in a subclass to opt out.
+            'ram': web2py's cache.ram of environment, per process.
+            'disk': web2py's cache.disk, shared by the processes of a host
+                if share_data_versions() was called, otherwise each process
+                keeps its own pages, see data_version().
+            a PageCache, or any callable with the signature of cache.ram,
+                eg cache.memcache.
+
+        Pages are cached for page_cache_ttl seconds, or until invalidate()
+        changes the data version of their table, which cud() does.
+
+        Args:
+            environment: dict, eg: globals()
+            table: gluon.dal.Table instance
+            query: gluon.dal.Query instance
+            fields: list of field names
+            render: function returning the body, called on a miss
+
+        Return:
+            string
+        """
+        cache = cls.page_cache
+        if cache in ('ram', 'disk'):
+            cache = getattr(environment['cache'], cache)
+        elif isinstance(cache, PageCache):
+            cls.page_caches.add(cache)
+        rendered = []
+
+        def miss():
+            rendered.append(True)
+            return render()
+        body = cache(cls.page_cache_key(environment, table, query, fields),
+                miss, cls.page_cache_ttl)
+        with cls.page_cache_stats_lock:
+            stats = cls.page_cache_stats.setdefault(cls.__name__,
+                    {'hits': 0, 'misses': 0})
+            stats['misses' if rendered else 'hits'] += 1
+        return body
+
+    # Field types not worth an index for filtering or sorting
+    unindexed_field_types = ('text', 'blob', 'boolean', 'json')
+
+    @classmethod
+    def index_advice(cls, table, jqgrid_options=None):
+        """Return the indexes which would support sorting and filtering a
+        jqgrid of table.
+
+        For each sortable column, an index on (column, id), which serves the
+        orderby and keyset paging. For each searchable column, an index on
+        (column, sortname, id), sortname being the default sort column, which
+        serves filtering and sorting at once. An index which is a prefix of
+        another one is left out.
+
+        Args:
+            table: gluon.dal.Table instance
+            jqgrid_options: dict, with the colModel and sortname of the
+                jqgrid, if None, those of default_jqgrid_options and all
+                fields.
+
+        Return:
+            list of dicts, eg [{'table': 'things',
+                'columns': ['price', 'id'], 'reasons': ['sort on price'],
+                'exists': False, 'sql': 'CREATE INDEX ...'}, ...]
+            exists is None if the indexes of the database are not known, see
+            table_indexes().
+        """
+        options = dict(cls.default_jqgrid_options, **(jqgrid_options or {}))
+        col_model = options.get('colModel') or \
+                [{'name': f, 'index': f} for f in table.fields]
+        sortname = options.get('sortname')
+        if sortname not in table.fields or \
+                table[sortname].type in cls.unindexed_field_types:
+            sortname = None
+
+        def indexable(c, option):
+            name = c.get('index') or c.get('name')
+            if c.get(option, True) is False or name not in table.fields:
+                return None
+            if table[name].type in cls.unindexed_field_types or \
+                    table[name].type.startswith('list:'):
+                return None
+            return name
+        wanted = []         # (columns, reason)
+        for c in col_model:
+            name = indexable(c, 'sortable')
+            if name:
+                wanted.append(([name, 'id'] if name != 'id' else ['id'],
+                        'sort on %s' % name))
+            name = indexable(c, 'search')
+            if name and name != 'id':
+                columns = [name]
+                if sortname and sortname != name:
+                    columns += [sortname, 'id'] if sortname != 'id' \
+                            else ['id']
+                wanted.append((columns, 'filter on %s' % name))
+
+        existing = cls.table_indexes(table)
+        implicit_id = table._db._adapter.dbengine in ('sqlite', 'mysql')
+        advice = []
+        # Longest first, so a prefix joins the index it is a prefix of
+        for columns, reason in sorted(wanted, key=lambda x: -len(x[0])):
+            for other in advice:
+                if other['columns'][:len(columns)] == columns:
+                    other['reasons'].append(reason)
+                    break
+            else:
+                advice.append({'table': str(table), 'columns': columns,
+                        'reasons': [reason]})
+        for a in advice:
+            a['exists'] = None if existing is None else bool([x for x in
+                    existing if cls.index_covers(x, a['columns'],
+                        implicit_id)])
+            a['sql'] = 'CREATE INDEX %s ON %s (%s);' % (
+                    cls.index_name(table, a['columns']), table,
+                    ', '.join(a['columns']))
+        return advice
+
+    @staticmethod
+    def index_covers(index, columns, implicit_id=False):
+        """Return True if an index on the index columns serves as an index on
+        columns, ie columns are a prefix of it.
+
+        Args:
+            index: list of column names of an existing index
+            columns: list of column names of the wanted index
+            implicit_id: True if the database appends the primary key to
+                every index, as SQLite and MySQL (InnoDB) do.
+        """
+        if implicit_id and columns[-1:] == ['id'] and index[-1:] != ['id']:
+            index = index + ['id']
+        return index[:len(columns)] == columns
+
+    @staticmethod
+    def index_name(table, columns):
+        """Return the name of an index on columns of table, eg
+        ix_things_price_id, shortened to fit every database.
+        """
+        name = 'ix_%s_%s' % (table, '_'.join(columns))
+        if len(name) > 30:
+            name = '%s_%s' % (name[:21], hashlib.md5(name).hexdigest()[:8])
+        return name
+
+    @staticmethod
+    def table_indexes(table):
+        """Return the columns of the existing indexes on table, as known to
+        SQLite, PostgreSQL and MySQL. The primary key counts as one.
+
+        Override this method in a subclass for other databases.
+
+        Args:
+            table: gluon.dal.Table instance
+
+        Return:
+            list of lists of column names, eg [['id'], ['price', 'id']], or
+            None if unknown.
+        """
+        db = table._db
+        engine = db._adapter.dbengine
+        indexes = [['id']]
+        if engine == 'sqlite':
+            for index in db.executesql('PRAGMA index_list("%s");' % table):
+                indexes.append([str(x[2]) for x in sorted(db.executesql(
+                        'PRAGMA index_info("%s");' % index[1]))])
+        elif engine == 'postgres':
+            names = dict(db.executesql("SELECT a.attnum, a.attname "
+                    "FROM pg_attribute a JOIN pg_class c "
+                    "ON c.oid = a.attrelid WHERE c.relname = '%s' "
+                    "AND a.attnum > 0;" % table))
+            for (indkey, ) in db.executesql("SELECT x.indkey::text "
+                    "FROM pg_index x JOIN pg_class c ON c.oid = x.indrelid "
+                    "WHERE c.relname = '%s';" % table):
+                indexes.append([names.get(int(x), '') for x in indkey.split()])
+        elif engine == 'mysql':
+            columns = {}
+            for row in db.executesql('SHOW INDEX FROM %s;' % table):
+                columns.setdefault(row[2], []).append((row[3], row[4]))
+            indexes += [[x[1] for x in sorted(v)] for v in columns.values()]
+        else:
+            return None
+        return indexes
+
+    @staticmethod
+    def query_plan(db, sql):
+        """Return the query plan of sql, as lines of text.
+
+        Args:
+            db: gluon.dal.DAL instance
+            sql: string, eg: db(query)._select(...)
+        """
+        explain = 'EXPLAIN QUERY PLAN ' \
+                if db._adapter.dbengine == 'sqlite' else 'EXPLAIN '
+        try:
+            return [' '.join(str(x) for x in row) for row in
+                    db.executesql(explain + sql.rstrip(';'))]
+        except Exception as err:
+            return ['No query plan: %s' % err]
+
+    @classmethod
+    def index_report(cls, db, grids=None, create=False):
+        """Report the indexes missing for the jqgrids of db, see
+        index_advice(), and optionally create them.
+
+        Each entry has the query plans of a typical jqgrid query the index
+        serves, before and, if created, after creating it.
+
+        Usage, from appadmin or a script, eg:
+            python web2py.py -S jqgrid -M -N
+            >>> from applications.jqgrid.modules.jqgrid import JqGrid
+            >>> for a in JqGrid.index_report(db, create=True):
+            ...     print a['sql'], a['exists'], a['after']
+
+        Args:
+            db: gluon.dal.DAL instance
+            grids: list of tuples (table, jqgrid_options), if None, the
+                jqgrids of db created since the server started.
+            create: boolean, True to create the missing indexes.
+
+        Return:
+            list of dicts, see index_advice(), with the query plans in
+            'before' and 'after'.
+        """
+        if grids is None:
+            grids = [(db[t], o) for (uri_hash, list_table_id), (t, o) in
+                    sorted(cls.registered_grids.items())
+                    if uri_hash == db._uri_hash and t in db.tables]
+        report = []
+        for table, jqgrid_options in grids:
+            for advice in cls.index_advice(table, jqgrid_options):
+                if [x for x in report if x['table'] == advice['table'] and
+                        x['columns'] == advice['columns']]:
+                    continue
+                columns = [table[f] for f in advice['columns']]
+                sample = db(columns[0] != None).select(columns[0],
+                        limitby=(0, 1)).first()
+                if len(columns) > 1 and sample and \
+                        advice['reasons'][0].startswith('filter'):
+                    query = columns[0] == sample[columns[0]]
+                    orderby = columns[1:]
+                else:
+                    query, orderby = table.id > 0, columns
+                rownum = (jqgrid_options or {}).get('rowNum') or \
+                        cls.default_jqgrid_options['rowNum']
+                sql = db(query)._select(table.id, orderby=orderby,
+                        limitby=(0, rownum))
+                advice['before'] = cls.query_plan(db, sql)
+                advice['after'] = None
+                if create and advice['exists'] is False:
+                    db.executesql(advice['sql'])
+                    db.commit()
+                    advice['exists'] = True
+                    advice['after'] = cls.query_plan(db, sql)
+                report.append(advice)
+        return report
+
+    @classmethod
+    def cud_callback(cls, environment, table, form=None, ids=None):
+        """Callback called after cud update.
+
+        Intended to be overridden in subclass.
+        Args:
+            form: the crud form of an edit or add, None for a delete
+            ids: list of the ids of the records added, edited or deleted
+        """
+        pass
+
+    def search_box(self):
+        """Return a HTML input searching the full_text_fields of the jqgrid,
+        or '' if there are none.
+
+        Typing reloads the jqgrid with the words in w2p_search, ranked, see
+        data().
+        """
+        if not self.full_text_fields:
+            return ''
+        return DIV(INPUT(_id='%s_search' % self.list_table_id, _type='text',
+                _placeholder='Search'), SCRIPT("""
+            jQuery('#%(id)s_search').keyup(function(){
+                var input = this;
+                clearTimeout(jQuery.data(input, 'timer'));
+                jQuery.data(input, 'timer', setTimeout(function(){
+                    jQuery('#%(id)s').jqGrid('setGridParam', {
+                        postData: {w2p_search: input.value},
+                        sortname: input.value ? '' : %(sortname)s,
+                        page: 1
+                    }).trigger('reloadGrid');
+                }, 300));
+            });""" % {'id': self.list_table_id, 'sortname': dumps(
+                    self.jqgrid_options.get('sortname', ''))}),
+                _class='jqgrid_search')
+
+    def list(self):
+        """Return a HTML table representing jqgrid list."""
+        return TABLE(_id=self.list_table_id)
+
+    def pager(self):
+        """Return a HTML div representing jqgrid pager."""
+        return DIV(_id=self.pager_div_id)
+
+    def script(self):
+        """Return a HTML script representing jqgrid javascript.
+
+        The script is generated once per distinct options, and kept in
+        scripts, as a template the per request script_url_options, eg: url,
+        are injected into.
+        """
+        # so user has chance for customizing, between __init__() and script()
+        urls = dict((k, self.jqgrid_options[k])
+                for k in self.script_url_options
+                if isinstance(self.jqgrid_options.get(k), basestring))
+        if not self.script_cache_size:
+            return SCRIPT(self.generate_script(self.jqgrid_options))
+        options = dict(self.jqgrid_options,
+                **dict((k, Raw('__W2P_URL_%s__' % k)) for k in urls))
+        names = set(m.group('named') or m.group('braced')
+                for m in Template.pattern.finditer(self.template))
+        try:
+            signature = hashlib.md5(cPickle.dumps((self.template, options,
+                    [(k, self.__dict__.get(k)) for k in sorted(names)
+                        if k and k not in ('basic_options', 'extra')],
+                    self.nav_grid_options, self.nav_edit_options,
+                    self.nav_add_options, self.nav_del_options,
+                    self.nav_search_options, self.nav_view_options,
+                    self.filter_toolbar_options, self.set_group_headers,
+                    self.list_table_id, self.pager_div_id,
+                    ), 2)).digest()
+        except (cPickle.PicklingError, TypeError):
+            # Unpicklable options, eg: objects of the user, are not cached
+            return SCRIPT(self.generate_script(self.jqgrid_options))
+        with self.scripts_lock:
+            cached = self.scripts.pop(signature, None)
+            if cached is not None:
+                self.scripts[signature] = cached
+        if cached is None:
+            template = self.generate_script(options).replace('%', '%%')
+            for k in urls:
+                template = template.replace('__W2P_URL_%s__' % k,
+                        '%%(%s)s' % k)
+            cached = (template, self.grid_features[self.list_table_id])
+            with self.scripts_lock:
+                self.scripts[signature] = cached
+                while len(self.scripts) > self.script_cache_size:
+                    self.scripts.popitem(last=False)
+        template, self.grid_features[self.list_table_id] = cached
+        return SCRIPT(template % dict((k, dumps(v)) for k, v in urls.items()))
+
+    def generate_script(self, jqgrid_options):
+        """Return the jqgrid javascript, for the jqgrid_options given."""
+        self.basic_options = dumps(jqgrid_options)[1:-1]    # Strip quotes
         self.extra = ''
         if isinstance(self.nav_grid_options, dict):
             self.extra += \
@@ -564,7 +3726,10 @@ class JqGrid(object):
         if self.set_group_headers:
             self.extra += "jQuery('#%s').jqGrid('setGroupHeaders',%s);" % (
                     self.list_table_id, dumps(self.set_group_headers))
-        return SCRIPT(Template(self.template).safe_substitute(self.__dict__))
+        script = Template(self.template).safe_substitute(self.__dict__)
+        # Remembered for the custom jqGrid build, see jqgrid_build()
+        self.grid_features[self.list_table_id] = self.used_features(script)
+        return script
 
 
 def dumps(obj, **kwargs):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the jqgrid data and script paths.
+
+Usage, from the web2py folder:
+    python web2py.py -S jqgrid -R applications/jqgrid/scripts/benchmark.py
+
+Prints the best of 5 runs of:
+    data_rows: one 10000-row page of a things table in SQLite in memory,
+        with and without JqGrid.raw_rows, for all columns and for 4.
+    dumps: the jqgrid options of 100 colModel entries, each with three
+        javascript functions. To compare encoders, run it with the
+        modules/jqgrid.py of each revision.
+"""
+import datetime
+import importlib
+import random
+import timeit
+
+from gluon.dal import DAL, Field
+
+jqgrid = importlib.import_module(
+        'applications.%s.modules.jqgrid' % request.application)
+JqGrid, Raw, dumps = jqgrid.JqGrid, jqgrid.Raw, jqgrid.dumps
+
+
+def make_db(records):
+    """Return a SQLite db in memory with a things table of records."""
+    db = DAL('sqlite:memory')
+    db.define_table('category', Field('name'), format='%(name)s')
+    db.define_table('things', Field('name'), Field('quantity', 'integer'),
+        Field('owner'), Field('cost', 'double'), Field('price', 'double'),
+        Field('expire', 'date'), Field('category', db.category),
+        Field('active', 'boolean', default=True),
+        Field('created_on', 'datetime'))
+    r = random.Random(1)
+    for i in range(10):
+        db.category.insert(name='cat%02d' % i)
+    for i in range(records):
+        db.things.insert(name='name%04d' % r.randint(0, 500),
+            quantity=r.randint(0, 100), owner='own%d' % r.randint(0, 9),
+            cost=r.randint(1, 1000) / 10.0, price=r.randint(1, 1000) / 10.0,
+            expire=datetime.date(2012, r.randint(1, 12), r.randint(1, 28)),
+            category=r.randint(1, 10), active=bool(r.randint(0, 1)),
+            created_on=datetime.datetime(2012, r.randint(1, 12),
+                r.randint(1, 28), r.randint(0, 23)))
+    return db
+
+
+def best(function, repeat=5):
+    """Return the best time of function, in milliseconds."""
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def benchmark_data_rows(records=10000):
+    db = make_db(records)
+
+    class RawJqGrid(JqGrid):
+        raw_rows = True
+    query = db.things.id > 0
+    orderby = [~db.things.price]
+    for fields in (db.things.fields, ['id', 'name', 'price', 'owner']):
+        times = [best(lambda: grid.data_rows(db.things, query, orderby,
+                (0, records), fields)) for grid in (JqGrid, RawJqGrid)]
+        print 'data_rows, %d fields: %.0f ms, raw_rows: %.0f ms' % (
+                len(fields), times[0], times[1])
+
+
+def benchmark_dumps(columns=100):
+    options = {'colModel': [{'name': 'c%d' % i, 'index': 'c%d' % i,
+            'editable': True,
+            'formatter': Raw(
+                'function(v, o, r){ return "<b>" + v + "</b>"; }'),
+            'unformat': Raw('function(v){ return v; }'),
+            'editoptions': {'size': 10, 'dataInit': Raw(
+                'function(el){ jQuery(el).datepicker(); }')}}
+            for i in range(columns)], 'caption': 'things', 'rowNum': 10}
+    print 'dumps, %d columns: %.1f ms' % (columns,
+            best(lambda: [dumps(options) for i in range(100)]) / 100)
+
+
+benchmark_data_rows()
+benchmark_dumps()